@@ -0,0 +1,285 @@
+"""
+Admission Control Module
+Limits concurrent work on the inference endpoints and sheds load early.
+
+Requests beyond the concurrency limit wait in a bounded queue ordered by
+priority (interactive captures before bulk uploads) and, within a priority,
+by per-user fair share. A request is rejected immediately, with Retry-After,
+when its user already holds its share (429), the queue is full (503), or its
+estimated wait exceeds its deadline (503), so accepted requests keep a stable
+tail latency under overload.
+
+Limits are per process. For the queue to be this one rather than the server's
+own (gunicorn gthread's executor queue, or the dev server's pool), the server
+must run at least serving_threads() request threads: waiting here only blocks a
+thread on an event, and the admitted requests stay within the CPU budget.
+"""
+
+import asyncio
+import math
+import os
+import threading
+import time
+from collections import OrderedDict, defaultdict, deque
+
+import numpy as np
+
+from execution_config import get_request_threads
+from emotion_events import SSE_MAX_THREADED_SUBSCRIBERS
+from mjpeg_output import MAX_THREADED_VIEWERS
+
+# Priorities (lower is served first)
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 1
+
+# Configuration (per process: get_request_threads is this worker's share of the CPU budget)
+MAX_CONCURRENT = int(os.environ.get('ADMISSION_MAX_CONCURRENT', 0)) or get_request_threads()
+MAX_QUEUE = int(os.environ.get('ADMISSION_MAX_QUEUE', 0)) or MAX_CONCURRENT * 4
+# Threads beyond admitted + queued requests, SSE and MJPEG, for cheap API calls
+HEADROOM_THREADS = int(os.environ.get('ADMISSION_HEADROOM_THREADS', 4))
+# Connections a threaded server accepts beyond its threads; past that it refuses
+ACCEPT_BACKLOG = int(os.environ.get('SERVER_ACCEPT_BACKLOG', 16))
+USER_SHARE = float(os.environ.get('ADMISSION_USER_SHARE', 0.25))
+DEADLINES = {
+    PRIORITY_INTERACTIVE: float(os.environ.get('ADMISSION_INTERACTIVE_DEADLINE_MS', 2000)) / 1000.0,
+    PRIORITY_BULK: float(os.environ.get('ADMISSION_BULK_DEADLINE_MS', 5000)) / 1000.0
+}
+SERVICE_EWMA_ALPHA = 0.2
+LATENCY_WINDOW = 1000
+
+class Rejected(Exception):
+    """Raised when a request is shed; carries the HTTP status and Retry-After."""
+
+    def __init__(self, status, reason, retry_after):
+        super().__init__(reason)
+        self.status = status
+        self.reason = reason
+        self.retry_after = max(1, int(math.ceil(retry_after)))
+
+class _Waiter:
+    """A queued request; granted through a threading.Event or an asyncio future."""
+
+    def __init__(self, user, priority, loop=None):
+        self.user = user
+        self.priority = priority
+        self.enqueued_at = time.perf_counter()
+        self.granted = False
+        self.event = threading.Event()
+        self.loop = loop
+        self.future = loop.create_future() if loop is not None else None
+
+    def grant(self):
+        self.granted = True
+        if self.future is not None:
+            self.loop.call_soon_threadsafe(self._resolve)
+        else:
+            self.event.set()
+
+    def _resolve(self):
+        if not self.future.done():
+            self.future.set_result(True)
+
+class AdmissionController:
+    """Concurrency limiter with a bounded, prioritized, per-user fair queue."""
+
+    def __init__(self, max_concurrent=MAX_CONCURRENT, max_queue=MAX_QUEUE, user_share=USER_SHARE):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.per_user_limit = max(1, int(math.ceil((max_concurrent + max_queue) * user_share)))
+        self._lock = threading.Lock()
+        self._queues = {PRIORITY_INTERACTIVE: OrderedDict(), PRIORITY_BULK: OrderedDict()}
+        self._queued = 0
+        self._active = 0
+        self._user_load = defaultdict(int)
+        self._service_ewma = None
+        self._counters = defaultdict(int)
+        self._queue_waits = deque(maxlen=LATENCY_WINDOW)
+        self._service_times = deque(maxlen=LATENCY_WINDOW)
+
+    # -- internal helpers (lock held) ------------------------------------
+
+    def _service_estimate(self):
+        return self._service_ewma if self._service_ewma is not None else 0.5
+
+    def _estimated_wait(self, priority):
+        ahead = sum(len(waiters) for p, users in self._queues.items() if p <= priority
+                    for waiters in users.values())
+        return (ahead + 1) * self._service_estimate() / self.max_concurrent
+
+    def _reject(self, status, reason, retry_after):
+        self._counters[f'rejected_{reason}'] += 1
+        return Rejected(status, reason, retry_after)
+
+    def _check(self, user, priority, deadline):
+        """
+        Admit immediately (returns False) or decide the request may queue (True).
+
+        Raises:
+            Rejected: If the request must be shed
+        """
+        if self._user_load[user] >= self.per_user_limit:
+            raise self._reject(429, 'user_share', self._service_estimate())
+
+        if self._active < self.max_concurrent and self._queued == 0:
+            self._admit(user)
+            return False
+
+        if self._queued >= self.max_queue:
+            raise self._reject(503, 'queue_full', self._estimated_wait(priority))
+
+        estimated = self._estimated_wait(priority)
+        if estimated > deadline:
+            raise self._reject(503, 'deadline', estimated)
+        return True
+
+    def _admit(self, user):
+        self._active += 1
+        self._user_load[user] += 1
+        self._counters['admitted'] += 1
+
+    def _enqueue(self, waiter):
+        self._queues[waiter.priority].setdefault(waiter.user, deque()).append(waiter)
+        self._queued += 1
+        self._user_load[waiter.user] += 1
+
+    def _remove(self, waiter):
+        users = self._queues[waiter.priority]
+        waiters = users.get(waiter.user)
+        if waiters and waiter in waiters:
+            waiters.remove(waiter)
+            if not waiters:
+                del users[waiter.user]
+            self._queued -= 1
+            self._user_load[waiter.user] -= 1
+
+    def _pop_next(self):
+        """Highest priority first; within it, the queued user with the least load."""
+        for priority in sorted(self._queues):
+            users = self._queues[priority]
+            if not users:
+                continue
+            user = min(users, key=lambda u: self._user_load[u])
+            waiters = users[user]
+            waiter = waiters.popleft()
+            if waiters:
+                users.move_to_end(user)
+            else:
+                del users[user]
+            self._queued -= 1
+            return waiter
+        return None
+
+    def _dispatch(self):
+        while self._active < self.max_concurrent and self._queued > 0:
+            waiter = self._pop_next()
+            # Queued load moves to active load for the same user
+            self._active += 1
+            self._counters['admitted'] += 1
+            self._queue_waits.append(time.perf_counter() - waiter.enqueued_at)
+            waiter.grant()
+
+    # -- public API --------------------------------------------------------
+
+    def acquire(self, user, priority=PRIORITY_BULK, deadline=None):
+        """
+        Block until admitted (threaded servers).
+
+        Returns:
+            tuple: Ticket to pass to release()
+
+        Raises:
+            Rejected: If the request is shed
+        """
+        deadline = DEADLINES[priority] if deadline is None else deadline
+        with self._lock:
+            if not self._check(user, priority, deadline):
+                return (user, time.perf_counter())
+            waiter = _Waiter(user, priority)
+            self._enqueue(waiter)
+
+        if not waiter.event.wait(deadline):
+            with self._lock:
+                if not waiter.granted:
+                    self._remove(waiter)
+                    raise self._reject(503, 'timeout', self._estimated_wait(priority))
+        return (user, time.perf_counter())
+
+    async def acquire_async(self, user, priority=PRIORITY_BULK, deadline=None):
+        """Async variant of acquire() that waits without holding a thread."""
+        deadline = DEADLINES[priority] if deadline is None else deadline
+        with self._lock:
+            if not self._check(user, priority, deadline):
+                return (user, time.perf_counter())
+            waiter = _Waiter(user, priority, asyncio.get_running_loop())
+            self._enqueue(waiter)
+
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.future), deadline)
+        except asyncio.TimeoutError:
+            with self._lock:
+                if not waiter.granted:
+                    self._remove(waiter)
+                    raise self._reject(503, 'timeout', self._estimated_wait(priority))
+        except asyncio.CancelledError:
+            # Client went away while queued: give back the slot if it was granted
+            with self._lock:
+                granted = waiter.granted
+                if not granted:
+                    self._remove(waiter)
+            if granted:
+                self.release((user, time.perf_counter()))
+            raise
+        return (user, time.perf_counter())
+
+    def release(self, ticket):
+        """Finish an admitted request and hand its slot to the next waiter."""
+        user, admitted_at = ticket
+        service = time.perf_counter() - admitted_at
+        with self._lock:
+            self._active -= 1
+            self._user_load[user] -= 1
+            if self._user_load[user] <= 0:
+                del self._user_load[user]
+            self._service_times.append(service)
+            self._service_ewma = (service if self._service_ewma is None
+                                  else self._service_ewma + SERVICE_EWMA_ALPHA * (service - self._service_ewma))
+            self._dispatch()
+
+    def metrics(self):
+        """Snapshot of admission counters, queue state and latency percentiles."""
+        with self._lock:
+            waits = list(self._queue_waits)
+            services = list(self._service_times)
+            counters = dict(self._counters)
+            return {
+                'max_concurrent': self.max_concurrent,
+                'max_queue': self.max_queue,
+                'per_user_limit': self.per_user_limit,
+                'active': self._active,
+                'queued': self._queued,
+                'service_ewma_ms': round(self._service_estimate() * 1000, 1),
+                'admitted': counters.pop('admitted', 0),
+                'rejected': counters,
+                'queue_wait_ms': _percentiles(waits),
+                'service_ms': _percentiles(services)
+            }
+
+def serving_threads():
+    """
+    Request threads a server process needs so overload queues here, not in its pool.
+
+    Includes the threads SSE subscribers and MJPEG viewers may hold
+    (SSE_MAX_THREADED_SUBSCRIBERS, MJPEG_MAX_THREADED_VIEWERS).
+    """
+    return (MAX_CONCURRENT + MAX_QUEUE + HEADROOM_THREADS
+            + SSE_MAX_THREADED_SUBSCRIBERS + MAX_THREADED_VIEWERS)
+
+def _percentiles(samples):
+    if not samples:
+        return {'p50': None, 'p99': None}
+    values = np.array(samples) * 1000
+    return {'p50': round(float(np.percentile(values, 50)), 1),
+            'p99': round(float(np.percentile(values, 99)), 1)}
+
+# Process-wide controller shared by the Flask and ASGI entry points
+admission = AdmissionController()
@@ -4,6 +4,9 @@ Detects emotions from webcam feed and uploaded images using a trained CNN model.
 """
 
 from flask import Flask, render_template, Response, request, jsonify, send_file
+from functools import wraps
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.serving import BaseWSGIServer
 import cv2
 import os
 import numpy as np
@@ -12,15 +15,23 @@ from PIL import Image
 import io
 from datetime import datetime
 import json
+import threading
 
 # Import custom modules
-from face_emotions import detect_emotion
+from face_emotions import detect_emotion, detect_emotion_with_face, annotate_frame, start_background_warmup, is_model_ready, get_readiness
 from database import insert_detection, get_detections, get_emotion_statistics
+from execution_config import apply_execution_config
+from emotion_events import emotion_events, sse_stream, DEFAULT_STREAM, SSE_MAX_THREADED_SUBSCRIBERS, SSE_RETRY_MS
+from stream_manager import get_stream_manager
+from mjpeg_output import MJPEGEncoder, MAX_THREADED_VIEWERS
+from admission import admission, Rejected, PRIORITY_INTERACTIVE, PRIORITY_BULK, serving_threads, ACCEPT_BACKLOG
+from storage_manager import StorageManager, MANAGER_INTERVAL
 
 # Configuration
-UPLOAD_FOLDER = 'uploads'
+UPLOAD_FOLDER = os.environ.get('UPLOAD_FOLDER', 'uploads')
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
 MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # 16MB max file size
+MODEL_WARMUP = os.environ.get('MODEL_WARMUP', 'True') == 'True'
 
 # Create Flask app
 app = Flask(__name__)
@@ -30,6 +41,15 @@ app.config['MAX_CONTENT_LENGTH'] = MAX_CONTENT_LENGTH
 # Create uploads folder if it doesn't exist
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
+# Load and warm up the model in the background so workers can boot immediately
+if MODEL_WARMUP:
+    start_background_warmup()
+
+# SSE connections and MJPEG viewers each hold a request thread for as long as
+# they stay open (see /api/emotion/stream and /video_feed)
+sse_slots = threading.BoundedSemaphore(SSE_MAX_THREADED_SUBSCRIBERS)
+mjpeg_slots = threading.BoundedSemaphore(MAX_THREADED_VIEWERS)
+
 # Initialize webcam
 camera = None
 current_emotion = "Neutral"
@@ -39,6 +59,49 @@ def allowed_file(filename):
     """Check if file has allowed extension."""
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+def build_filename(user_name, suffix):
+    """Build a timestamped, sanitized filename for a stored image."""
+    return secure_filename(f"{user_name}_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{suffix}")
+
+def decode_data_url(image_b64):
+    """
+    Decode a base64 image (optionally a data URL) into a BGR frame.
+    
+    Raises:
+        ValueError: If the payload is not a decodable image
+    """
+    import base64
+    try:
+        # strip header if present
+        if ',' in image_b64:
+            image_b64 = image_b64.split(',', 1)[1]
+        img_bytes = base64.b64decode(image_b64)
+        img = Image.open(io.BytesIO(img_bytes)).convert('RGB')
+        return cv2.cvtColor(np.array(img), cv2.COLOR_RGB2BGR)
+    except Exception as e:
+        raise ValueError(f"Invalid image data: {e}")
+
+def detection_result(emotion, user_name, record_id, filename):
+    """Build the JSON body returned by /upload and /capture."""
+    return {
+        'success': True,
+        'emotion': emotion,
+        'user_name': user_name,
+        'timestamp': datetime.now().isoformat(),
+        'record_id': record_id,
+        'filename': filename
+    }
+
+def format_history(records):
+    """Convert database rows into the /api/history record format."""
+    return [{
+        'id': record[0],
+        'user_name': record[1],
+        'emotion': record[3],
+        'timestamp': record[6],
+        'method': record[5]
+    } for record in records]
+
 def get_camera():
     """Get or initialize the camera."""
     global camera
@@ -57,12 +120,51 @@ def release_camera():
         camera.release()
         camera = None
 
-def generate_frames():
-    """Generate frames from webcam for live streaming."""
+def request_user():
+    """Identify the caller for fair-share admission (user_name, else client address)."""
+    user_name = request.form.get('user_name')
+    if not user_name:
+        data = request.get_json(silent=True, force=True)
+        if isinstance(data, dict):
+            user_name = data.get('user_name')
+    return str(user_name or request.remote_addr or 'anonymous').strip()
+
+def rejected_response(error):
+    """Build the fast 429/503 response for a shed request."""
+    response = jsonify({'error': 'Server busy, please retry', 'reason': error.reason})
+    response.status_code = error.status
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response
+
+def admission_controlled(priority):
+    """Run the wrapped view only once admitted by the inference admission controller."""
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            try:
+                ticket = admission.acquire(request_user(), priority)
+            except Rejected as e:
+                return rejected_response(e)
+            try:
+                return view(*args, **kwargs)
+            finally:
+                admission.release(ticket)
+        return wrapper
+    return decorator
+
+def _camera_frames():
+    """
+    Read webcam frames, detecting on every other one; yields (frame, annotations).
+    
+    The last detection's box and label are redrawn on the frames in between, so
+    annotations only change when a detection does and unchanged frames can be
+    reused by the encoder.
+    """
     global current_emotion, current_confidence
     
     camera = get_camera()
     frame_count = 0
+    annotations = None
     
     while True:
         try:
@@ -76,25 +178,28 @@ def generate_frames():
             # Process every nth frame to reduce computation
             if frame_count % 2 == 0:
                 try:
-                    emotion = detect_emotion(frame)
+                    emotion, confidence, face = detect_emotion_with_face(frame)
                     current_emotion = emotion
+                    current_confidence = confidence
+                    emotion_events.publish(emotion, confidence)
+                    annotations = (emotion, face)
                 except Exception as e:
                     print(f"Error detecting emotion: {e}")
-                    emotion = "Error"
+                    annotations = None
+            elif annotations is not None and annotations[1] is not None:
+                annotate_frame(frame, annotations[1], annotations[0])
             
-            # Encode frame to JPEG
-            ret, buffer = cv2.imencode('.jpg', frame)
-            if not ret:
-                continue
-                
-            frame_bytes = buffer.tobytes()
-            yield (b'--frame\r\n'
-                   b'Content-Type: image/jpeg\r\n\r\n' + frame_bytes + b'\r\n')
+            yield frame, annotations
                    
         except Exception as e:
             print(f"Error in frame generation: {e}")
             break
 
+def generate_frames():
+    """Generate MJPEG parts from webcam for live streaming."""
+    # Per-viewer encoder: skips unchanged frames and adapts quality/size to the client
+    return MJPEGEncoder().stream(_camera_frames())
+
 @app.route('/')
 def index():
     """Render the main page."""
@@ -106,15 +211,21 @@ def index():
 
 @app.route('/video_feed')
 def video_feed():
-    """Stream video feed from webcam."""
+    """Stream video feed from webcam (at most MJPEG_MAX_THREADED_VIEWERS per process)."""
+    if not mjpeg_slots.acquire(blocking=False):
+        return "Too many video feed viewers", 503, {'Retry-After': '5'}
     try:
-        return Response(generate_frames(), 
-                       mimetype='multipart/x-mixed-replace; boundary=frame')
+        response = Response(generate_frames(), 
+                           mimetype='multipart/x-mixed-replace; boundary=frame')
+        response.call_on_close(mjpeg_slots.release)
+        return response
     except Exception as e:
+        mjpeg_slots.release()
         print(f"Error in video feed: {e}")
         return f"Error: {str(e)}", 500
 
 @app.route('/upload', methods=['POST'])
+@admission_controlled(PRIORITY_BULK)
 def upload_file():
     """
     Handle file upload for emotion detection.
@@ -145,7 +256,7 @@ def upload_file():
             return jsonify({'error': 'File type not allowed. Use: PNG, JPG, JPEG, GIF'}), 400
         
         # Save file
-        filename = secure_filename(f"{user_name}_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{file.filename}")
+        filename = build_filename(user_name, file.filename)
         filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
         file.save(filepath)
         
@@ -165,14 +276,7 @@ def upload_file():
             detection_method='upload'
         )
         
-        return jsonify({
-            'success': True,
-            'emotion': emotion,
-            'user_name': user_name,
-            'timestamp': datetime.now().isoformat(),
-            'record_id': record_id,
-            'filename': filename
-        }), 200
+        return jsonify(detection_result(emotion, user_name, record_id, filename)), 200
         
     except Exception as e:
         print(f"Error in upload: {e}")
@@ -190,6 +294,31 @@ def get_current_emotion():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/emotion/stream', methods=['GET'])
+def stream_current_emotion():
+    """
+    Push emotion updates as Server-Sent Events.
+    
+    Only sends when the emotion (or confidence, beyond a threshold) changes;
+    /api/emotion remains available as a polling fallback. Each connection
+    holds a request thread, so subscribers are capped per process and every
+    connection is closed after SSE_MAX_SECONDS (the browser reconnects).
+    """
+    if not sse_slots.acquire(blocking=False):
+        response = jsonify({'error': 'Too many event stream subscribers; poll /api/emotion instead'})
+        response.headers['Retry-After'] = str(max(1, SSE_RETRY_MS // 1000))
+        return response, 503
+
+    stream_id = request.args.get('stream', DEFAULT_STREAM)
+    if stream_id != DEFAULT_STREAM:
+        # Under gunicorn this starts relaying the model server's stream results here
+        get_stream_manager()
+    response = Response(sse_stream(emotion_events, stream_id), mimetype='text/event-stream')
+    response.call_on_close(sse_slots.release)
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
 @app.route('/api/history', methods=['GET'])
 def get_history():
     """Get detection history for a user."""
@@ -198,16 +327,7 @@ def get_history():
         limit = request.args.get('limit', default=20, type=int)
         
         records = get_detections(user_name, limit)
-        
-        history = []
-        for record in records:
-            history.append({
-                'id': record[0],
-                'user_name': record[1],
-                'emotion': record[3],
-                'timestamp': record[6],
-                'method': record[5]
-            })
+        history = format_history(records)
         
         return jsonify({
             'success': True,
@@ -235,7 +355,50 @@ def get_stats():
         print(f"Error getting statistics: {e}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/streams', methods=['GET'])
+def list_streams():
+    """List watched video sources with per-stream and scheduler stats."""
+    try:
+        return jsonify({'success': True, **get_stream_manager().stats()}), 200
+    except Exception as e:
+        print(f"Error listing streams: {e}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/streams', methods=['POST'])
+def add_stream():
+    """
+    Start watching a video source.
+    
+    Expects JSON:
+        - stream_id: Identifier used in stats and /api/emotion/stream?stream=<id>
+        - source: Camera index, RTSP/HTTP URL or video file path
+        - sample_fps: Frames sampled per second (optional)
+    """
+    try:
+        data = request.get_json(silent=True) or {}
+        stream_id = str(data.get('stream_id') or '').strip()
+        source = str(data.get('source') or '').strip()
+        if not stream_id or not source:
+            return jsonify({'error': 'stream_id and source are required'}), 400
+        
+        sample_fps = float(data.get('sample_fps') or 5)
+        stream = get_stream_manager().add_source(stream_id, source, sample_fps)
+        return jsonify({'success': True, 'stream': stream.snapshot()}), 201
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        print(f"Error adding stream: {e}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/streams/<stream_id>', methods=['DELETE'])
+def remove_stream(stream_id):
+    """Stop watching a video source."""
+    if get_stream_manager().remove_source(stream_id):
+        return jsonify({'success': True}), 200
+    return jsonify({'error': f"Stream '{stream_id}' not found"}), 404
+
 @app.route('/capture', methods=['POST'])
+@admission_controlled(PRIORITY_INTERACTIVE)
 def capture_frame():
     """Capture and save current frame from webcam."""
     try:
@@ -259,14 +422,8 @@ def capture_frame():
         # If client provided an image (data URL), decode it
         if image_b64:
             try:
-                import base64
-                # strip header if present
-                if ',' in image_b64:
-                    image_b64 = image_b64.split(',', 1)[1]
-                img_bytes = base64.b64decode(image_b64)
-                img = Image.open(io.BytesIO(img_bytes)).convert('RGB')
-                frame = cv2.cvtColor(np.array(img), cv2.COLOR_RGB2BGR)
-            except Exception as e:
+                frame = decode_data_url(image_b64)
+            except ValueError as e:
                 print(f"Error decoding client image: {e}")
                 return jsonify({'error': 'Invalid image data'}), 400
         else:
@@ -280,7 +437,7 @@ def capture_frame():
         emotion = detect_emotion(frame)
 
         # Save frame
-        filename = secure_filename(f"{user_name}_{datetime.now().strftime('%Y%m%d_%H%M%S')}_webcam.jpg")
+        filename = build_filename(user_name, 'webcam.jpg')
         filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
         try:
             cv2.imwrite(filepath, frame)
@@ -295,19 +452,17 @@ def capture_frame():
             detection_method='webcam'
         )
 
-        return jsonify({
-            'success': True,
-            'emotion': emotion,
-            'user_name': user_name,
-            'timestamp': datetime.now().isoformat(),
-            'record_id': record_id,
-            'filename': filename
-        }), 200
+        return jsonify(detection_result(emotion, user_name, record_id, filename)), 200
         
     except Exception as e:
         print(f"Error capturing frame: {e}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/admission', methods=['GET'])
+def admission_metrics():
+    """Admission control metrics: active/queued requests, shed counts and latencies."""
+    return jsonify(admission.metrics()), 200
+
 @app.route('/health', methods=['GET'])
 def health():
     """Health check endpoint."""
@@ -318,11 +473,23 @@ def health():
         return jsonify({
             'status': 'ok',
             'camera_connected': camera_ok,
+            'execution': apply_execution_config(),
             'timestamp': datetime.now().isoformat()
         }), 200
     except Exception as e:
         return jsonify({'status': 'error', 'message': str(e)}), 500
 
+@app.route('/ready', methods=['GET'])
+def ready():
+    """Readiness check: 200 once the model is loaded and warmed up, 503 before."""
+    if get_readiness()['status'] == 'idle':
+        # Nothing has loaded the model yet (MODEL_WARMUP=False): start now
+        start_background_warmup()
+    state = get_readiness()
+    state['ready'] = is_model_ready()
+    state['timestamp'] = datetime.now().isoformat()
+    return jsonify(state), 200 if state['ready'] else 503
+
 @app.errorhandler(404)
 def not_found(error):
     """Handle 404 errors."""
@@ -338,6 +505,39 @@ def cleanup(exception):
     """Cleanup resources on app shutdown."""
     release_camera()
 
+class PooledWSGIServer(BaseWSGIServer):
+    """
+    Development server that handles requests on a fixed-size thread pool.
+    
+    At most `backlog` accepted connections wait for a thread; beyond that a
+    connection is answered 503 straight away instead of queueing without limit.
+    """
+
+    def __init__(self, host, port, wsgi_app, threads, backlog=ACCEPT_BACKLOG):
+        super().__init__(host, port, wsgi_app)
+        self.pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='request')
+        self.slots = threading.BoundedSemaphore(threads + backlog)
+
+    def process_request(self, request, client_address):
+        if not self.slots.acquire(blocking=False):
+            try:
+                request.sendall(b'HTTP/1.1 503 Service Unavailable\r\nRetry-After: 1\r\n'
+                                b'Content-Length: 0\r\nConnection: close\r\n\r\n')
+            except OSError:
+                pass
+            self.shutdown_request(request)
+            return
+        self.pool.submit(self._process_request_thread, request, client_address)
+
+    def _process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self.slots.release()
+
 if __name__ == '__main__':
     try:
         # Get port from environment or use default
@@ -349,10 +549,17 @@ if __name__ == '__main__':
         print("=" * 60)
         print(f"Starting on http://0.0.0.0:{port}")
         print(f"Debug Mode: {debug_mode}")
+        print(f"Execution Profile: {apply_execution_config()}")
         print("=" * 60)
         
-        # Run app
-        app.run(host='0.0.0.0', port=port, debug=debug_mode, threaded=True)
+        # Run app on a bounded request pool (app.run(threaded=True) has no limit),
+        # sized so overload queues in admission control rather than in the pool
+        app.debug = debug_mode
+        # Thumbnail/archive/retention passes (STORAGE_MANAGER_INTERVAL seconds; off by default).
+        # Started here rather than at import: gunicorn runs them in their own process
+        if MANAGER_INTERVAL > 0:
+            StorageManager().start(MANAGER_INTERVAL)
+        PooledWSGIServer('0.0.0.0', port, app, serving_threads()).serve_forever()
         
     except Exception as e:
         print(f"Error starting application: {e}")
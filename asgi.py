@@ -0,0 +1,600 @@
+"""
+ASGI Entry Point
+Serves the same routes as app.py on an event loop. Decoding, detection,
+inference and SQLite writes are offloaded to bounded thread pools, and the
+MJPEG stream is fanned out from one shared capture loop through async
+generators, so idle stream viewers and API pollers don't each hold a thread.
+
+Usage:
+    uvicorn asgi:app --host 0.0.0.0 --port 5000
+"""
+
+import asyncio
+import functools
+import os
+import struct
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from datetime import datetime
+
+import cv2
+import numpy as np
+from flask import render_template
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, HTMLResponse, StreamingResponse
+from starlette.routing import Route, Mount, WebSocketRoute
+from starlette.websockets import WebSocket, WebSocketDisconnect
+from starlette.staticfiles import StaticFiles
+
+# Reuse the Flask app's configuration, helpers and camera handling
+import app as webapp
+from face_emotions import detect_emotion, detect_emotion_with_face, annotate_frame, detect_emotion_gray, is_model_ready, get_readiness, start_background_warmup
+from database import insert_detection, get_detections, get_emotion_statistics
+from execution_config import get_request_threads, apply_execution_config
+from emotion_events import emotion_events, sse_stream_async, DEFAULT_STREAM
+from stream_manager import get_stream_manager, DEFAULT_SAMPLE_FPS
+from mjpeg_output import MJPEGEncoder
+from storage_manager import StorageManager, MANAGER_INTERVAL
+from admission import admission, Rejected, PRIORITY_INTERACTIVE, PRIORITY_BULK
+
+# Configuration
+INFERENCE_THREADS = get_request_threads()
+IO_THREADS = int(os.environ.get('ASGI_IO_THREADS', 2))
+# Jobs allowed to wait for an inference thread before callers queue on the loop
+INFERENCE_QUEUE_LIMIT = int(os.environ.get('ASGI_INFERENCE_QUEUE', INFERENCE_THREADS * 4))
+STREAM_DETECT_EVERY = 2
+# Binary ingest frames: little-endian uint16 width, uint16 height, then pixels
+INGEST_HEADER = struct.Struct('<HH')
+INGEST_MAX_DIMENSION = 1280
+
+# Bounded executors: CPU-bound detection/inference, and blocking file/SQLite I/O
+inference_executor = ThreadPoolExecutor(max_workers=INFERENCE_THREADS, thread_name_prefix='inference')
+io_executor = ThreadPoolExecutor(max_workers=IO_THREADS, thread_name_prefix='io')
+# Camera reads and JPEG encoding for the shared stream stay on one thread
+capture_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='capture')
+_inference_slots = asyncio.Semaphore(INFERENCE_QUEUE_LIMIT)
+
+async def run_inference(func, *args):
+    """Run a CPU-bound call on the inference pool, bounded by INFERENCE_QUEUE_LIMIT."""
+    async with _inference_slots:
+        return await asyncio.get_running_loop().run_in_executor(inference_executor, func, *args)
+
+async def run_io(func, *args):
+    """Run a blocking file or database call on the I/O pool."""
+    return await asyncio.get_running_loop().run_in_executor(io_executor, func, *args)
+
+async def request_user(request):
+    """Identify the caller for fair-share admission (user_name, else client address)."""
+    user_name = None
+    try:
+        if request.headers.get('content-type', '').startswith('multipart/form-data'):
+            user_name = (await request.form()).get('user_name')
+        else:
+            data = await request.json()
+            if isinstance(data, dict):
+                user_name = data.get('user_name')
+    except Exception:
+        pass
+    client = request.client.host if request.client else None
+    return str(user_name or client or 'anonymous').strip()
+
+def admission_controlled(priority):
+    """Run the wrapped endpoint only once admitted; waiting holds no thread."""
+    def decorator(endpoint):
+        @functools.wraps(endpoint)
+        async def wrapper(request):
+            try:
+                ticket = await admission.acquire_async(await request_user(request), priority)
+            except Rejected as e:
+                return JSONResponse({'error': 'Server busy, please retry', 'reason': e.reason},
+                                    status_code=e.status, headers={'Retry-After': str(e.retry_after)})
+            try:
+                return await endpoint(request)
+            finally:
+                admission.release(ticket)
+        return wrapper
+    return decorator
+
+class CameraBroadcaster:
+    """
+    Single capture loop for the server camera shared by all MJPEG viewers.
+
+    The loop runs only while at least one viewer is connected; each viewer is an
+    async generator waiting on a condition, so it costs no thread. Frames are
+    encoded once for all viewers, and slow viewers simply skip to the newest
+    part, so quality isn't adapted per client here.
+    """
+
+    def __init__(self):
+        self.encoder = MJPEGEncoder(adaptive=False)
+        self.viewers = 0
+        self.part = None
+        self.version = 0
+        self._condition = None
+        self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        camera = await loop.run_in_executor(capture_executor, webapp.get_camera)
+        frame_count = 0
+        # Redrawn on the frames between detections so they match the last one
+        annotations = None
+        try:
+            while self.viewers > 0:
+                success, frame = await loop.run_in_executor(capture_executor, camera.read)
+                if not success:
+                    print("Failed to read from camera")
+                    break
+
+                frame_count += 1
+                if frame_count % STREAM_DETECT_EVERY == 0:
+                    try:
+                        emotion, confidence, face = await run_inference(detect_emotion_with_face, frame)
+                        webapp.current_emotion = emotion
+                        webapp.current_confidence = confidence
+                        emotion_events.publish(emotion, confidence)
+                        annotations = (emotion, face)
+                    except Exception as e:
+                        print(f"Error detecting emotion: {e}")
+                        annotations = None
+                elif annotations is not None and annotations[1] is not None:
+                    annotate_frame(frame, annotations[1], annotations[0])
+
+                part = await loop.run_in_executor(capture_executor, self.encoder.encode, frame, annotations)
+                if part is None or part is self.part:
+                    # Encoding failed or the frame is unchanged; nothing new to send
+                    continue
+
+                async with self._condition:
+                    self.part = part
+                    self.version += 1
+                    self._condition.notify_all()
+        except Exception as e:
+            print(f"Error in frame generation: {e}")
+        finally:
+            async with self._condition:
+                self._condition.notify_all()
+
+    async def frames(self):
+        """Async generator of multipart MJPEG parts for one viewer."""
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        self.viewers += 1
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        task = self._task
+
+        try:
+            seen = self.version
+            while True:
+                async with self._condition:
+                    await self._condition.wait_for(lambda: self.version != seen or task.done())
+                    if self.version == seen:
+                        break
+                    seen = self.version
+                    part = self.part
+                yield part
+        finally:
+            self.viewers -= 1
+
+camera_stream = CameraBroadcaster()
+
+_index_html = None
+
+async def index(request):
+    """Render the main page (rendered once through Flask's Jinja environment)."""
+    global _index_html
+    try:
+        if _index_html is None:
+            with webapp.app.test_request_context('/'):
+                _index_html = render_template('index.html')
+        return HTMLResponse(_index_html)
+    except Exception as e:
+        print(f"Error rendering index: {e}")
+        return HTMLResponse(f"Error loading page: {str(e)}", status_code=500)
+
+async def video_feed(request):
+    """Stream video feed from the shared server camera loop."""
+    return StreamingResponse(camera_stream.frames(),
+                             media_type='multipart/x-mixed-replace; boundary=frame')
+
+def _decode_image_bytes(contents):
+    """Decode uploaded image bytes into a BGR frame (None if undecodable)."""
+    return cv2.imdecode(np.frombuffer(contents, dtype=np.uint8), cv2.IMREAD_COLOR)
+
+def _write_file(filepath, contents):
+    with open(filepath, 'wb') as f:
+        f.write(contents)
+
+@admission_controlled(PRIORITY_BULK)
+async def upload_file(request):
+    """Handle file upload for emotion detection (same contract as app.py)."""
+    try:
+        form = await request.form()
+        file = form.get('file')
+        user_name = (form.get('user_name') or '').strip()
+
+        if file is None or not hasattr(file, 'filename'):
+            return JSONResponse({'error': 'No file provided'}, status_code=400)
+
+        if not user_name:
+            return JSONResponse({'error': 'User name is required'}, status_code=400)
+
+        if file.filename == '':
+            return JSONResponse({'error': 'No file selected'}, status_code=400)
+
+        if not webapp.allowed_file(file.filename):
+            return JSONResponse({'error': 'File type not allowed. Use: PNG, JPG, JPEG, GIF'}, status_code=400)
+
+        contents = await file.read()
+        if len(contents) > webapp.MAX_CONTENT_LENGTH:
+            return JSONResponse({'error': 'File too large'}, status_code=413)
+
+        filename = webapp.build_filename(user_name, file.filename)
+        filepath = os.path.join(webapp.UPLOAD_FOLDER, filename)
+        await run_io(_write_file, filepath, contents)
+
+        image = await run_inference(_decode_image_bytes, contents)
+        if image is None:
+            return JSONResponse({'error': 'Failed to read image'}, status_code=400)
+
+        emotion = await run_inference(detect_emotion, image)
+
+        record_id = await run_io(lambda: insert_detection(
+            user_name=user_name,
+            image_path=filepath,
+            detected_emotion=emotion,
+            detection_method='upload'
+        ))
+
+        return JSONResponse(webapp.detection_result(emotion, user_name, record_id, filename))
+
+    except Exception as e:
+        print(f"Error in upload: {e}")
+        return JSONResponse({'error': f'Server error: {str(e)}'}, status_code=500)
+
+@admission_controlled(PRIORITY_INTERACTIVE)
+async def capture_frame(request):
+    """Capture and save a client-sent (base64) or server-camera frame."""
+    try:
+        try:
+            data = await request.json()
+        except Exception:
+            data = None
+
+        user_name = None
+        image_b64 = None
+        if isinstance(data, dict):
+            user_name = data.get('user_name')
+            image_b64 = data.get('image')
+
+        if not user_name or not str(user_name).strip():
+            return JSONResponse({'error': 'User name is required'}, status_code=400)
+
+        if image_b64:
+            try:
+                frame = await run_inference(webapp.decode_data_url, image_b64)
+            except ValueError as e:
+                print(f"Error decoding client image: {e}")
+                return JSONResponse({'error': 'Invalid image data'}, status_code=400)
+        else:
+            loop = asyncio.get_running_loop()
+            camera = await loop.run_in_executor(capture_executor, webapp.get_camera)
+            success, frame = await loop.run_in_executor(capture_executor, camera.read)
+            if not success or frame is None:
+                return JSONResponse({'error': 'Failed to capture frame from server camera. If you are using your browser webcam, allow camera access and try Capture again.'}, status_code=400)
+
+        emotion = await run_inference(detect_emotion, frame)
+
+        filename = webapp.build_filename(user_name, 'webcam.jpg')
+        filepath = os.path.join(webapp.UPLOAD_FOLDER, filename)
+        try:
+            await run_io(cv2.imwrite, filepath, frame)
+        except Exception as e:
+            print(f"Failed to write image to disk: {e}")
+
+        record_id = await run_io(lambda: insert_detection(
+            user_name=user_name,
+            image_path=filepath,
+            detected_emotion=emotion,
+            detection_method='webcam'
+        ))
+
+        return JSONResponse(webapp.detection_result(emotion, user_name, record_id, filename))
+
+    except Exception as e:
+        print(f"Error capturing frame: {e}")
+        return JSONResponse({'error': str(e)}, status_code=500)
+
+async def get_current_emotion(request):
+    """Get the current detected emotion from the server camera stream."""
+    return JSONResponse({
+        'emotion': webapp.current_emotion,
+        'confidence': webapp.current_confidence,
+        'timestamp': datetime.now().isoformat()
+    })
+
+async def stream_current_emotion(request):
+    """Push emotion updates as Server-Sent Events (no thread per subscriber)."""
+    stream_id = request.query_params.get('stream', DEFAULT_STREAM)
+    if stream_id != DEFAULT_STREAM:
+        # With a model server this starts relaying its stream results here
+        await run_io(get_stream_manager)
+    return StreamingResponse(
+        sse_stream_async(emotion_events, stream_id),
+        media_type='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+class IngestSession:
+    """
+    State for one browser webcam streaming grayscale frames over a WebSocket.
+
+    Only the newest frame is kept: frames arriving while inference is busy
+    replace the pending one and are counted as dropped (backpressure). Frames
+    are downscaled grayscale for live analysis only; captures that get stored go
+    through POST /capture with the full-resolution colour frame.
+    """
+
+    def __init__(self, websocket, stream_id):
+        self.websocket = websocket
+        self.stream_id = stream_id
+        self.pending = None
+        self.frame_id = 0
+        self.dropped = 0
+        self.new_frame = asyncio.Event()
+        self.closed = False
+
+    def offer(self, gray):
+        """Store a received frame, replacing (dropping) any unprocessed one."""
+        self.frame_id += 1
+        if self.pending is not None:
+            self.dropped += 1
+        self.pending = (self.frame_id, time.perf_counter(), gray)
+        self.new_frame.set()
+
+    async def process(self):
+        """
+        Run inference on the newest frame whenever one is available.
+
+        A failed frame is reported to the client (so it sends the next one) and
+        the loop carries on; if the socket itself can't be written, it is closed
+        so the client reconnects instead of waiting on a result forever.
+        """
+        while not self.closed:
+            await self.new_frame.wait()
+            self.new_frame.clear()
+            if self.pending is None:
+                continue
+            frame_id, received, gray = self.pending
+            self.pending = None
+
+            try:
+                emotion, confidence, face = await run_inference(detect_emotion_gray, gray)
+                emotion_events.publish(emotion, confidence, self.stream_id)
+                message = {
+                    'type': 'result',
+                    'frame_id': frame_id,
+                    'emotion': emotion,
+                    'confidence': round(float(confidence), 4),
+                    'face': face,
+                    'latency_ms': round((time.perf_counter() - received) * 1000, 1),
+                    'dropped': self.dropped
+                }
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Error processing ingest frame: {e}")
+                message = {'type': 'error', 'frame_id': frame_id, 'error': 'Inference failed'}
+
+            try:
+                await self.websocket.send_json(message)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                if not self.closed:
+                    print(f"Error sending ingest result: {e}")
+                    await self.close(code=1011)
+                return
+
+    async def close(self, code=1000):
+        """Close the socket (the client reconnects on unexpected closes)."""
+        self.closed = True
+        self.new_frame.set()
+        try:
+            await self.websocket.close(code=code)
+        except Exception:
+            pass
+
+def _decode_ingest_frame(payload):
+    """
+    Decode a binary ingest message into a grayscale frame.
+
+    Raises:
+        ValueError: If the header or payload size is invalid
+    """
+    if len(payload) < INGEST_HEADER.size:
+        raise ValueError('Frame too short')
+    width, height = INGEST_HEADER.unpack_from(payload)
+    if not (0 < width <= INGEST_MAX_DIMENSION and 0 < height <= INGEST_MAX_DIMENSION):
+        raise ValueError(f'Invalid frame size {width}x{height}')
+    if len(payload) - INGEST_HEADER.size != width * height:
+        raise ValueError('Frame payload does not match header')
+    # Copy so the frame doesn't pin the websocket's receive buffer
+    return np.frombuffer(payload, dtype=np.uint8, offset=INGEST_HEADER.size).reshape(height, width).copy()
+
+async def ingest_socket(websocket: WebSocket):
+    """
+    Continuous inference for a browser webcam over one persistent WebSocket.
+
+    Client -> server:
+        binary: INGEST_HEADER (width, height) + width*height grayscale bytes
+    Server -> client:
+        {"type": "result", ...} per analysed frame, or {"type": "error", ...}
+
+    Nothing is stored here; captures use POST /capture with a full-resolution frame.
+    """
+    await websocket.accept()
+    session = IngestSession(websocket, websocket.query_params.get('stream', 'browser'))
+    worker = asyncio.create_task(session.process())
+    try:
+        while True:
+            message = await websocket.receive()
+            if message['type'] == 'websocket.disconnect':
+                break
+
+            if message.get('bytes') is not None:
+                try:
+                    session.offer(_decode_ingest_frame(message['bytes']))
+                except ValueError as e:
+                    await websocket.send_json({'type': 'error', 'error': str(e)})
+            elif message.get('text') is not None:
+                await websocket.send_json({'type': 'error', 'error': 'Send frames as binary messages; capture with POST /capture'})
+    except WebSocketDisconnect:
+        pass
+    except Exception as e:
+        print(f"Error in ingest socket: {e}")
+    finally:
+        session.closed = True
+        session.new_frame.set()
+        worker.cancel()
+
+async def get_history(request):
+    """Get detection history for a user."""
+    try:
+        user_name = request.query_params.get('user_name')
+        try:
+            limit = int(request.query_params.get('limit', 20))
+        except ValueError:
+            limit = 20
+
+        records = await run_io(get_detections, user_name, limit)
+        history = webapp.format_history(records)
+
+        return JSONResponse({'success': True, 'records': history, 'total': len(history)})
+
+    except Exception as e:
+        print(f"Error getting history: {e}")
+        return JSONResponse({'error': str(e)}, status_code=500)
+
+async def get_stats(request):
+    """Get emotion statistics."""
+    try:
+        user_name = request.query_params.get('user_name')
+        stats = await run_io(get_emotion_statistics, user_name)
+        return JSONResponse({'success': True, 'statistics': stats})
+
+    except Exception as e:
+        print(f"Error getting statistics: {e}")
+        return JSONResponse({'error': str(e)}, status_code=500)
+
+async def list_streams(request):
+    """List watched video sources with per-stream and scheduler stats."""
+    try:
+        stats = await run_io(lambda: get_stream_manager().stats())
+        return JSONResponse({'success': True, **stats})
+    except Exception as e:
+        print(f"Error listing streams: {e}")
+        return JSONResponse({'error': str(e)}, status_code=500)
+
+async def add_stream(request):
+    """Start watching a video source (same JSON body as the Flask route)."""
+    try:
+        try:
+            data = await request.json()
+        except ValueError:
+            data = {}
+        data = data if isinstance(data, dict) else {}
+        stream_id = str(data.get('stream_id') or '').strip()
+        source = str(data.get('source') or '').strip()
+        if not stream_id or not source:
+            return JSONResponse({'error': 'stream_id and source are required'}, status_code=400)
+
+        sample_fps = float(data.get('sample_fps') or DEFAULT_SAMPLE_FPS)
+        snapshot = await run_io(lambda: get_stream_manager().add_source(stream_id, source, sample_fps).snapshot())
+        return JSONResponse({'success': True, 'stream': snapshot}, status_code=201)
+    except ValueError as e:
+        return JSONResponse({'error': str(e)}, status_code=400)
+    except Exception as e:
+        print(f"Error adding stream: {e}")
+        return JSONResponse({'error': str(e)}, status_code=500)
+
+async def remove_stream(request):
+    """Stop watching a video source."""
+    stream_id = request.path_params['stream_id']
+    if await run_io(lambda: get_stream_manager().remove_source(stream_id)):
+        return JSONResponse({'success': True})
+    return JSONResponse({'error': f"Stream '{stream_id}' not found"}, status_code=404)
+
+async def admission_metrics(request):
+    """Admission control metrics: active/queued requests, shed counts and latencies."""
+    return JSONResponse(admission.metrics())
+
+async def health(request):
+    """Health check endpoint."""
+    try:
+        camera = await asyncio.get_running_loop().run_in_executor(capture_executor, webapp.get_camera)
+        return JSONResponse({
+            'status': 'ok',
+            'camera_connected': camera is not None and camera.isOpened(),
+            'execution': apply_execution_config(),
+            'timestamp': datetime.now().isoformat()
+        })
+    except Exception as e:
+        return JSONResponse({'status': 'error', 'message': str(e)}, status_code=500)
+
+async def ready(request):
+    """Readiness check: 200 once the model is loaded and warmed up, 503 before."""
+    if get_readiness()['status'] == 'idle':
+        # Nothing has loaded the model yet (MODEL_WARMUP=False): start now
+        start_background_warmup()
+    state = get_readiness()
+    state['ready'] = is_model_ready()
+    state['timestamp'] = datetime.now().isoformat()
+    return JSONResponse(state, status_code=200 if state['ready'] else 503)
+
+async def not_found(request, exc):
+    """Handle 404 errors."""
+    return JSONResponse({'error': 'Endpoint not found'}, status_code=404)
+
+async def internal_error(request, exc):
+    """Handle 500 errors."""
+    return JSONResponse({'error': 'Internal server error'}, status_code=500)
+
+@asynccontextmanager
+async def lifespan(application):
+    """Start storage passes if configured; release the camera and executors on shutdown."""
+    storage = None
+    if MANAGER_INTERVAL > 0:
+        storage = StorageManager()
+        storage.start(MANAGER_INTERVAL)
+    yield
+    if storage is not None:
+        storage.stop()
+    webapp.release_camera()
+    for executor in (inference_executor, io_executor, capture_executor):
+        executor.shutdown(wait=False, cancel_futures=True)
+
+app = Starlette(
+    routes=[
+        Route('/', index),
+        Route('/video_feed', video_feed),
+        Route('/upload', upload_file, methods=['POST']),
+        Route('/capture', capture_frame, methods=['POST']),
+        Route('/api/emotion', get_current_emotion, methods=['GET']),
+        Route('/api/emotion/stream', stream_current_emotion, methods=['GET']),
+        Route('/api/history', get_history, methods=['GET']),
+        Route('/api/statistics', get_stats, methods=['GET']),
+        Route('/api/streams', list_streams, methods=['GET']),
+        Route('/api/streams', add_stream, methods=['POST']),
+        Route('/api/streams/{stream_id}', remove_stream, methods=['DELETE']),
+        Route('/api/admission', admission_metrics, methods=['GET']),
+        Route('/health', health, methods=['GET']),
+        Route('/ready', ready, methods=['GET']),
+        WebSocketRoute('/ws/ingest', ingest_socket),
+        Mount('/static', StaticFiles(directory=os.path.join(os.path.dirname(__file__), 'static')), name='static')
+    ],
+    exception_handlers={404: not_found, 500: internal_error},
+    lifespan=lifespan
+)
@@ -1,21 +1,48 @@
 """
 Database module for storing emotion detection results.
 Stores: user names, uploaded/captured images, and model predictions.
+
+Detections are kept in two tiers. Recent months live in the SQLite
+emotion_detections table. Closed months are moved by archive_closed_months()
+into one compressed columnar file per month: a NumPy .npz with the emotion,
+user and method columns dictionary-encoded. get_detections and
+get_emotion_statistics read both tiers transparently.
 """
 
 import sqlite3
 import os
-from datetime import datetime
+from collections import Counter, OrderedDict
+from datetime import datetime, timezone
 from pathlib import Path
+import threading
+
+import numpy as np
 
 DATABASE_NAME = "emotion_detection_results.db"
-DATABASE_PATH = os.path.join(os.path.dirname(__file__), DATABASE_NAME)
+DATABASE_PATH = os.environ.get('DATABASE_PATH', os.path.join(os.path.dirname(__file__), DATABASE_NAME))
+
+# Archive tier: one detections_YYYY-MM.npz per closed month
+ARCHIVE_FOLDER = os.environ.get('DETECTION_ARCHIVE_FOLDER',
+                                os.path.join(os.path.dirname(__file__), 'detection_archive'))
+# Months kept in SQLite, counting the current one
+HOT_MONTHS = int(os.environ.get('DETECTION_HOT_MONTHS', 2))
+DETECTION_COLUMNS = ('id', 'user_name', 'image_path', 'detected_emotion', 'confidence',
+                     'detection_method', 'timestamp', 'notes', 'thumbnail_path')
+DICTIONARY_COLUMNS = ('user_name', 'detected_emotion', 'detection_method')
+
+# Schema is created lazily on the first connection instead of at import
+_schema_ready = False
+_schema_lock = threading.Lock()
 
 def init_database():
     """Initialize database with required schema."""
     conn = sqlite3.connect(DATABASE_PATH)
     cursor = conn.cursor()
     
+    # Lets storage_manager reclaim free pages incrementally (applies to new
+    # database files; existing ones are converted by compact_database)
+    cursor.execute('PRAGMA auto_vacuum = INCREMENTAL')
+    
     # Create table for storing detection results
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS emotion_detections (
@@ -26,13 +53,51 @@ def init_database():
             confidence REAL,
             detection_method TEXT,
             timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-            notes TEXT
+            notes TEXT,
+            thumbnail_path TEXT
         )
     ''')
     
+    # Databases created before thumbnails existed get the column added in place
+    columns = {row[1] for row in cursor.execute('PRAGMA table_info(emotion_detections)')}
+    if 'thumbnail_path' not in columns:
+        cursor.execute('ALTER TABLE emotion_detections ADD COLUMN thumbnail_path TEXT')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_detections_timestamp
+        ON emotion_detections (timestamp)
+    ''')
+    
+    # Per-second emotion timeline produced by offline video analysis
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS emotion_timeline (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            video_path TEXT NOT NULL,
+            second INTEGER NOT NULL,
+            dominant_emotion TEXT NOT NULL,
+            confidence REAL,
+            face_count INTEGER,
+            emotion_counts TEXT,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_timeline_video
+        ON emotion_timeline (video_path, second)
+    ''')
+    
     conn.commit()
     conn.close()
 
+def _connect():
+    """Open a database connection, creating the schema on first use."""
+    global _schema_ready
+    if not _schema_ready:
+        with _schema_lock:
+            if not _schema_ready:
+                init_database()
+                _schema_ready = True
+    return sqlite3.connect(DATABASE_PATH)
+
 def insert_detection(user_name, image_path, detected_emotion, confidence=None, detection_method='webcam', notes=''):
     """
     Insert a new emotion detection record into the database.
@@ -49,7 +114,7 @@ def insert_detection(user_name, image_path, detected_emotion, confidence=None, d
         int: ID of inserted record or None if failed
     """
     try:
-        conn = sqlite3.connect(DATABASE_PATH)
+        conn = _connect()
         cursor = conn.cursor()
         
         cursor.execute('''
@@ -79,7 +144,7 @@ def get_detections(user_name=None, limit=50):
         list: List of detection records
     """
     try:
-        conn = sqlite3.connect(DATABASE_PATH)
+        conn = _connect()
         cursor = conn.cursor()
         
         if user_name:
@@ -99,6 +164,10 @@ def get_detections(user_name=None, limit=50):
         records = cursor.fetchall()
         conn.close()
         
+        # Archived months are all older than the hot tier, so they only fill the remainder
+        if len(records) < limit:
+            records.extend(_archived_detections(user_name, limit - len(records)))
+        
         return records
     except sqlite3.Error as e:
         print(f"Database error: {e}")
@@ -115,7 +184,7 @@ def get_emotion_statistics(user_name=None):
         dict: Dictionary with emotion counts
     """
     try:
-        conn = sqlite3.connect(DATABASE_PATH)
+        conn = _connect()
         cursor = conn.cursor()
         
         if user_name:
@@ -134,18 +203,74 @@ def get_emotion_statistics(user_name=None):
                 ORDER BY count DESC
             ''')
         
-        stats = {row[0]: row[1] for row in cursor.fetchall()}
+        stats = Counter({row[0]: row[1] for row in cursor.fetchall()})
         conn.close()
         
-        return stats
+        stats.update(_archived_statistics(user_name))
+        return dict(stats.most_common())
     except sqlite3.Error as e:
         print(f"Database error: {e}")
         return {}
 
+def insert_timeline_bulk(video_path, rows):
+    """
+    Insert a video's per-second emotion timeline in one transaction.
+    
+    Any existing timeline for the same video is replaced.
+    
+    Args:
+        video_path (str): Path of the analysed video
+        rows (list): Tuples of (second, dominant_emotion, confidence, face_count, emotion_counts_json)
+    
+    Returns:
+        int: Number of rows inserted (0 if failed)
+    """
+    try:
+        conn = _connect()
+        with conn:
+            conn.execute('DELETE FROM emotion_timeline WHERE video_path = ?', (video_path,))
+            conn.executemany('''
+                INSERT INTO emotion_timeline
+                (video_path, second, dominant_emotion, confidence, face_count, emotion_counts)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', [(video_path,) + tuple(row) for row in rows])
+        conn.close()
+        
+        return len(rows)
+    except sqlite3.Error as e:
+        print(f"Database error: {e}")
+        return 0
+
+def get_timeline(video_path):
+    """
+    Retrieve the per-second emotion timeline for a video.
+    
+    Returns:
+        list: Rows of (second, dominant_emotion, confidence, face_count, emotion_counts)
+    """
+    try:
+        conn = _connect()
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            SELECT second, dominant_emotion, confidence, face_count, emotion_counts
+            FROM emotion_timeline
+            WHERE video_path = ?
+            ORDER BY second
+        ''', (video_path,))
+        
+        rows = cursor.fetchall()
+        conn.close()
+        
+        return rows
+    except sqlite3.Error as e:
+        print(f"Database error: {e}")
+        return []
+
 def delete_detection(record_id):
     """Delete a detection record by ID."""
     try:
-        conn = sqlite3.connect(DATABASE_PATH)
+        conn = _connect()
         cursor = conn.cursor()
         
         cursor.execute('DELETE FROM emotion_detections WHERE id = ?', (record_id,))
@@ -158,6 +283,406 @@ def delete_detection(record_id):
         print(f"Database error: {e}")
         return False
 
-# Initialize database on module import
-if not os.path.exists(DATABASE_PATH):
-    init_database()
+def get_detections_without_thumbnail(limit=500):
+    """
+    Retrieve records that don't have a thumbnail yet.
+    
+    Returns:
+        list: Rows of (id, image_path, timestamp)
+    """
+    try:
+        conn = _connect()
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            SELECT id, image_path, timestamp FROM emotion_detections
+            WHERE thumbnail_path IS NULL
+            ORDER BY id
+            LIMIT ?
+        ''', (limit,))
+        
+        rows = cursor.fetchall()
+        conn.close()
+        
+        return rows
+    except sqlite3.Error as e:
+        print(f"Database error: {e}")
+        return []
+
+def get_detections_before(cutoff, limit=500, after_id=0):
+    """
+    Retrieve records older than a cutoff, oldest first, for batch processing.
+    
+    Args:
+        cutoff (str): UTC timestamp 'YYYY-MM-DD HH:MM:SS'
+        limit (int): Maximum number of records to retrieve
+        after_id (int): Only return records with a larger ID (for paging)
+    
+    Returns:
+        list: Rows of (id, image_path, thumbnail_path, timestamp)
+    """
+    try:
+        conn = _connect()
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            SELECT id, image_path, thumbnail_path, timestamp FROM emotion_detections
+            WHERE timestamp < ? AND id > ?
+            ORDER BY id
+            LIMIT ?
+        ''', (cutoff, after_id, limit))
+        
+        rows = cursor.fetchall()
+        conn.close()
+        
+        return rows
+    except sqlite3.Error as e:
+        print(f"Database error: {e}")
+        return []
+
+def update_storage_paths(updates):
+    """
+    Update image and thumbnail paths for many records in one transaction.
+    
+    Args:
+        updates (list): Tuples of (record_id, image_path, thumbnail_path)
+    
+    Returns:
+        bool: True if successful
+    """
+    try:
+        conn = _connect()
+        with conn:
+            conn.executemany('''
+                UPDATE emotion_detections SET image_path = ?, thumbnail_path = ?
+                WHERE id = ?
+            ''', [(image_path, thumbnail_path, record_id) for record_id, image_path, thumbnail_path in updates])
+        conn.close()
+        
+        return True
+    except sqlite3.Error as e:
+        print(f"Database error: {e}")
+        return False
+
+def delete_detections_bulk(record_ids):
+    """
+    Delete many detection records in one transaction.
+    
+    Returns:
+        int: Number of rows deleted (0 if failed)
+    """
+    try:
+        conn = _connect()
+        with conn:
+            cursor = conn.executemany('DELETE FROM emotion_detections WHERE id = ?',
+                                      [(record_id,) for record_id in record_ids])
+        conn.close()
+        
+        return cursor.rowcount
+    except sqlite3.Error as e:
+        print(f"Database error: {e}")
+        return 0
+
+def count_image_path_prefix(prefix):
+    """Count records whose image_path starts with a prefix (e.g. an archive file)."""
+    try:
+        conn = _connect()
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            SELECT COUNT(*) FROM emotion_detections
+            WHERE substr(image_path, 1, ?) = ?
+        ''', (len(prefix), prefix))
+        
+        count = cursor.fetchone()[0]
+        conn.close()
+        
+        for path in _partition_paths():
+            image_paths = _read_columns(path, ('image_path',))['image_path']
+            count += int(np.count_nonzero(np.char.startswith(image_paths, prefix)))
+        return count
+    except (sqlite3.Error, OSError, ValueError, KeyError) as e:
+        print(f"Database error: {e}")
+        return None
+
+def compact_database(max_pages=1000):
+    """
+    Reclaim free pages from the database file.
+    
+    Runs an incremental vacuum of at most max_pages pages. A database created
+    without auto_vacuum is converted once with a full VACUUM.
+    
+    Returns:
+        dict: Free pages before/after and whether a full VACUUM ran
+    """
+    try:
+        conn = _connect()
+        free_before = conn.execute('PRAGMA freelist_count').fetchone()[0]
+        full_vacuum = conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2
+        
+        if full_vacuum:
+            conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            conn.execute('VACUUM')
+        else:
+            # The pragma frees pages as its result rows are stepped through
+            conn.execute(f'PRAGMA incremental_vacuum({int(max_pages)})').fetchall()
+        
+        free_after = conn.execute('PRAGMA freelist_count').fetchone()[0]
+        conn.close()
+        
+        return {'free_pages_before': free_before, 'free_pages_after': free_after, 'full_vacuum': full_vacuum}
+    except sqlite3.Error as e:
+        print(f"Database error: {e}")
+        return {}
+
+# ---------------------------------------------------------------------------
+# Archive tier: month partitions in compressed columnar .npz files
+# ---------------------------------------------------------------------------
+
+# Emotion statistics results kept per (partition set, user_name)
+STATS_CACHE_SIZE = 256
+
+_counts_cache = {}
+_stats_cache = OrderedDict()
+_archive_lock = threading.Lock()
+
+def _month_start(months_back):
+    """UTC 'YYYY-MM-01 00:00:00' of the month `months_back` months before the current one."""
+    now = datetime.now(timezone.utc)
+    year, month = now.year, now.month - months_back
+    while month <= 0:
+        month += 12
+        year -= 1
+    return f"{year:04d}-{month:02d}-01 00:00:00"
+
+def _partition_path(month):
+    return os.path.join(ARCHIVE_FOLDER, f"detections_{month}.npz")
+
+def _partition_month(path):
+    return os.path.basename(path)[len('detections_'):-len('.npz')]
+
+def _partition_paths():
+    """Archive partition paths, newest month first."""
+    try:
+        names = [name for name in os.listdir(ARCHIVE_FOLDER)
+                 if name.startswith('detections_') and name.endswith('.npz')]
+    except FileNotFoundError:
+        return []
+    return [os.path.join(ARCHIVE_FOLDER, name) for name in sorted(names, reverse=True)]
+
+def _read_columns(path, names):
+    """Read only the named arrays from a partition (each .npz member is decompressed on access)."""
+    with np.load(path, allow_pickle=False) as data:
+        return {name: data[name] for name in names}
+
+def _read_rows(path, indices=None):
+    """
+    Rebuild SELECT * tuples for rows of a partition.
+    
+    Args:
+        path (str): Partition file
+        indices (np.ndarray): Row indices to return, in order (default: all rows)
+    """
+    names = [name for name in DETECTION_COLUMNS if name not in DICTIONARY_COLUMNS]
+    names += [f'{name}_{part}' for name in DICTIONARY_COLUMNS for part in ('dict', 'code')]
+    columns = _read_columns(path, names)
+    if indices is None:
+        indices = np.arange(len(columns['id']))
+    
+    decoded = {}
+    for name in DETECTION_COLUMNS:
+        if name in DICTIONARY_COLUMNS:
+            decoded[name] = columns[f'{name}_dict'][columns[f'{name}_code'][indices]].tolist()
+        else:
+            decoded[name] = columns[name][indices].tolist()
+    
+    decoded['confidence'] = [None if np.isnan(c) else c for c in decoded['confidence']]
+    decoded['thumbnail_path'] = [p or None for p in decoded['thumbnail_path']]
+    return list(zip(*(decoded[name] for name in DETECTION_COLUMNS)))
+
+def _user_code(user_dictionary, user_name):
+    """Code of user_name in a sorted dictionary column, or None if absent."""
+    index = int(np.searchsorted(user_dictionary, user_name))
+    if index < len(user_dictionary) and user_dictionary[index] == user_name:
+        return index
+    return None
+
+def _partition_counts(path):
+    """
+    Per-user emotion counts stored with a partition: (users, emotions, counts).
+    
+    Only these small arrays are read and cached, never the row columns.
+    """
+    mtime = os.path.getmtime(path)
+    with _archive_lock:
+        cached = _counts_cache.get(path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    
+    columns = _read_columns(path, ('user_name_dict', 'detected_emotion_dict', 'counts'))
+    entry = (columns['user_name_dict'], columns['detected_emotion_dict'].tolist(), columns['counts'])
+    with _archive_lock:
+        _counts_cache[path] = (mtime, entry)
+    return entry
+
+def _invalidate_archive_cache():
+    with _archive_lock:
+        _counts_cache.clear()
+        _stats_cache.clear()
+
+def _archived_detections(user_name, limit):
+    """Newest archived records (SELECT * tuples), reading only as many months as needed."""
+    records = []
+    for path in _partition_paths():
+        try:
+            columns = _read_columns(path, ('id', 'timestamp', 'user_name_dict', 'user_name_code'))
+            order = np.lexsort((columns['id'], columns['timestamp']))[::-1]
+            if user_name:
+                code = _user_code(columns['user_name_dict'], user_name)
+                if code is None:
+                    continue
+                order = order[columns['user_name_code'][order] == code]
+            
+            indices = order[:limit - len(records)]
+            if len(indices):
+                records.extend(_read_rows(path, indices))
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Error reading detection archive {path}: {e}")
+        if len(records) >= limit:
+            break
+    return records
+
+def _archived_statistics(user_name=None):
+    """Emotion counts over the archive tier, cached (LRU) until a partition changes."""
+    try:
+        paths = _partition_paths()
+        key = (tuple((path, os.path.getmtime(path)) for path in paths), user_name)
+        with _archive_lock:
+            if key in _stats_cache:
+                _stats_cache.move_to_end(key)
+                return _stats_cache[key]
+        
+        totals = Counter()
+        for path in paths:
+            users, emotions, counts = _partition_counts(path)
+            if user_name:
+                code = _user_code(users, user_name)
+                if code is None:
+                    continue
+                row = counts[code]
+            else:
+                row = counts.sum(axis=0)
+            totals.update({emotions[i]: int(n) for i, n in enumerate(row) if n})
+    except (OSError, ValueError, KeyError) as e:
+        print(f"Error reading detection archive statistics: {e}")
+        return Counter()
+    
+    with _archive_lock:
+        _stats_cache[key] = totals
+        while len(_stats_cache) > STATS_CACHE_SIZE:
+            _stats_cache.popitem(last=False)
+    return totals
+
+def _encode_dictionary(values):
+    """Dictionary-encode a string column into (sorted unique values, int32 codes)."""
+    dictionary, codes = np.unique(np.array(values, dtype=str), return_inverse=True)
+    return dictionary, codes.astype(np.int32)
+
+def _write_partition(path, rows):
+    """
+    Write SELECT * rows as a compressed columnar partition (atomically replaced).
+    
+    Besides one array per column, the partition stores a users x emotions count
+    matrix so statistics never need the row data.
+    """
+    values = dict(zip(DETECTION_COLUMNS, zip(*rows)))
+    arrays = {
+        'id': np.array(values['id'], dtype=np.int64),
+        'image_path': np.array([p or '' for p in values['image_path']], dtype=str),
+        'confidence': np.array([np.nan if c is None else c for c in values['confidence']], dtype=np.float64),
+        'timestamp': np.array([str(t) for t in values['timestamp']], dtype=str),
+        'notes': np.array([n or '' for n in values['notes']], dtype=str),
+        'thumbnail_path': np.array([p or '' for p in values['thumbnail_path']], dtype=str)
+    }
+    for name in DICTIONARY_COLUMNS:
+        arrays[f'{name}_dict'], arrays[f'{name}_code'] = _encode_dictionary([v or '' for v in values[name]])
+    
+    counts = np.zeros((len(arrays['user_name_dict']), len(arrays['detected_emotion_dict'])), dtype=np.int64)
+    np.add.at(counts, (arrays['user_name_code'], arrays['detected_emotion_code']), 1)
+    arrays['counts'] = counts
+    
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as f:
+        np.savez_compressed(f, **arrays)
+    os.replace(temp_path, path)
+
+def archive_closed_months(hot_months=HOT_MONTHS):
+    """
+    Move detections from closed months out of SQLite into month partitions.
+    
+    Each month's rows are written (merged with any existing partition for that
+    month) before exactly those rows are deleted from SQLite by id, so an
+    interrupted run never loses rows and re-running it is safe.
+    
+    Args:
+        hot_months (int): Months kept in SQLite, counting the current one
+    
+    Returns:
+        dict: Rows archived per month (empty if nothing to do or failed)
+    """
+    cutoff = _month_start(max(1, hot_months) - 1)
+    archived = {}
+    try:
+        conn = _connect()
+        months = [row[0] for row in conn.execute('''
+            SELECT DISTINCT substr(timestamp, 1, 7) FROM emotion_detections
+            WHERE timestamp < ?
+        ''', (cutoff,))]
+        
+        for month in sorted(months):
+            rows = conn.execute(f'''
+                SELECT {', '.join(DETECTION_COLUMNS)} FROM emotion_detections
+                WHERE substr(timestamp, 1, 7) = ? AND timestamp < ?
+            ''', (month, cutoff)).fetchall()
+            ids = [row[0] for row in rows]
+            
+            path = _partition_path(month)
+            partition_rows = list(rows)
+            if os.path.exists(path):
+                # Rows already archived by an interrupted run are not duplicated
+                new_ids = set(ids)
+                partition_rows += [row for row in _read_rows(path) if row[0] not in new_ids]
+            _write_partition(path, partition_rows)
+            
+            with conn:
+                conn.executemany('DELETE FROM emotion_detections WHERE id = ?', [(i,) for i in ids])
+            archived[month] = len(ids)
+        conn.close()
+    except (sqlite3.Error, OSError, ValueError, KeyError) as e:
+        print(f"Error archiving detections: {e}")
+    finally:
+        _invalidate_archive_cache()
+    
+    return archived
+
+def delete_archived_months(before_month):
+    """
+    Delete whole archived months older than `before_month` ('YYYY-MM').
+    
+    Returns:
+        list: (image_path, thumbnail_path) of the deleted records, so their
+            files can be removed
+    """
+    files = []
+    for path in _partition_paths():
+        if _partition_month(path) >= before_month:
+            continue
+        try:
+            columns = _read_columns(path, ('image_path', 'thumbnail_path'))
+            files.extend(zip(columns['image_path'].tolist(), columns['thumbnail_path'].tolist()))
+            os.remove(path)
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Error deleting detection archive {path}: {e}")
+    _invalidate_archive_cache()
+    return files
@@ -0,0 +1,198 @@
+"""
+Emotion Events Module
+Publishes the latest detected emotion per stream and wakes subscribers only
+when it changes, so browsers can receive Server-Sent Events instead of polling
+/api/emotion.
+"""
+
+import asyncio
+import json
+import os
+import threading
+import time
+from datetime import datetime
+
+# Configuration
+DEFAULT_STREAM = 'default'
+CONFIDENCE_DELTA = 0.05         # smaller confidence moves are not pushed
+HEARTBEAT_SECONDS = 15.0        # keep-alive comment for idle SSE connections
+MIN_PUSH_INTERVAL = 0.25        # per-subscriber coalescing window
+# Threaded (WSGI) servers hold a request thread per SSE connection. Those threads
+# only wait on a condition, so each process reserves room for many subscribers
+# (on top of its request threads), ends each connection after SSE_MAX_SECONDS,
+# and the browser reconnects on its own after SSE_RETRY_MS. Push at larger scale
+# is what the ASGI app (asgi.py) is for: its subscribers hold no thread at all.
+SSE_MAX_THREADED_SUBSCRIBERS = int(os.environ.get('SSE_MAX_THREADED_SUBSCRIBERS', 64))
+SSE_MAX_SECONDS = float(os.environ.get('SSE_MAX_SECONDS', 300))
+SSE_RETRY_MS = int(os.environ.get('SSE_RETRY_MS', 3000))
+
+class EmotionBroadcaster:
+    """
+    Latest-value store for per-stream emotion results with change notification.
+
+    Subscribers never see a backlog: when woken they read the current state, so
+    bursts of updates are coalesced into a single push.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._states = {}
+        self._version = 0
+        self._async_waiters = set()
+
+    def publish(self, emotion, confidence=0.0, stream_id=DEFAULT_STREAM):
+        """
+        Record a detection result and notify subscribers if it changed.
+
+        Args:
+            emotion (str): Detected emotion label
+            confidence (float): Prediction confidence (0-1)
+            stream_id (str): Stream the result belongs to
+
+        Returns:
+            bool: True if subscribers were notified
+        """
+        confidence = float(confidence or 0.0)
+        with self._condition:
+            previous = self._states.get(stream_id)
+            if (previous is not None and previous['emotion'] == emotion
+                    and abs(previous['confidence'] - confidence) < CONFIDENCE_DELTA):
+                return False
+
+            self._version += 1
+            self._states[stream_id] = {
+                'stream': stream_id,
+                'emotion': emotion,
+                'confidence': round(confidence, 4),
+                'timestamp': datetime.now().isoformat(),
+                'version': self._version
+            }
+            self._condition.notify_all()
+            waiters = list(self._async_waiters)
+
+        for loop, event in waiters:
+            try:
+                loop.call_soon_threadsafe(event.set)
+            except RuntimeError:
+                # Loop already closed; the waiter is discarded by its subscriber
+                pass
+        return True
+
+    def latest(self, stream_id=DEFAULT_STREAM):
+        """Return the current state for a stream (or None)."""
+        with self._condition:
+            state = self._states.get(stream_id)
+            return dict(state) if state else None
+
+    def wait_for_update(self, stream_id=DEFAULT_STREAM, since_version=0, timeout=HEARTBEAT_SECONDS):
+        """
+        Block until the stream's state is newer than since_version (threaded servers).
+
+        Returns:
+            dict or None: New state, or None on timeout
+        """
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while True:
+                state = self._states.get(stream_id)
+                if state is not None and state['version'] > since_version:
+                    return dict(state)
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self._condition.wait(remaining)
+
+    def updates_since(self, since_version=0, timeout=HEARTBEAT_SECONDS):
+        """
+        Block until any stream is newer than since_version (cross-process relay).
+
+        Returns:
+            list: Every state newer than since_version, or [] on timeout
+        """
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while True:
+                states = [dict(state) for state in self._states.values() if state['version'] > since_version]
+                if states:
+                    return sorted(states, key=lambda state: state['version'])
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return []
+                self._condition.wait(remaining)
+
+    async def wait_for_update_async(self, stream_id=DEFAULT_STREAM, since_version=0, timeout=HEARTBEAT_SECONDS):
+        """Async variant of wait_for_update that holds no thread while waiting."""
+        loop = asyncio.get_running_loop()
+        event = asyncio.Event()
+        waiter = (loop, event)
+        deadline = loop.time() + timeout
+        with self._condition:
+            self._async_waiters.add(waiter)
+        try:
+            while True:
+                state = self.latest(stream_id)
+                if state is not None and state['version'] > since_version:
+                    return state
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    return None
+                event.clear()
+                try:
+                    await asyncio.wait_for(event.wait(), remaining)
+                except asyncio.TimeoutError:
+                    return None
+        finally:
+            with self._condition:
+                self._async_waiters.discard(waiter)
+
+def format_sse(state):
+    """Format a state dict as a Server-Sent Events message."""
+    return f"event: emotion\nid: {state['version']}\ndata: {json.dumps(state)}\n\n"
+
+def sse_stream(broadcaster, stream_id=DEFAULT_STREAM, max_seconds=SSE_MAX_SECONDS):
+    """
+    Generator of SSE messages for threaded (WSGI) servers.
+
+    Ends after max_seconds so the request thread is returned to the pool; the
+    `retry:` field tells the browser how long to wait before reconnecting.
+    """
+    deadline = time.monotonic() + max_seconds
+    yield f"retry: {SSE_RETRY_MS}\n\n"
+
+    version = 0
+    state = broadcaster.latest(stream_id)
+    if state is not None:
+        version = state['version']
+        yield format_sse(state)
+
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return
+        state = broadcaster.wait_for_update(stream_id, version, min(HEARTBEAT_SECONDS, remaining))
+        if state is None:
+            yield ": heartbeat\n\n"
+            continue
+        version = state['version']
+        yield format_sse(state)
+        time.sleep(MIN_PUSH_INTERVAL)
+
+async def sse_stream_async(broadcaster, stream_id=DEFAULT_STREAM):
+    """Async generator of SSE messages for ASGI servers."""
+    version = 0
+    state = broadcaster.latest(stream_id)
+    if state is not None:
+        version = state['version']
+        yield format_sse(state)
+
+    while True:
+        state = await broadcaster.wait_for_update_async(stream_id, version)
+        if state is None:
+            yield ": heartbeat\n\n"
+            continue
+        version = state['version']
+        yield format_sse(state)
+        await asyncio.sleep(MIN_PUSH_INTERVAL)
+
+# Process-wide broadcaster shared by the Flask and ASGI entry points
+emotion_events = EmotionBroadcaster()
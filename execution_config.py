@@ -0,0 +1,155 @@
+"""
+Execution Configuration Module
+Keeps TensorFlow's intra/inter-op pools, OpenCV's thread pool and the request
+worker pool inside one CPU budget so concurrent requests don't oversubscribe
+cores.
+
+Profiles:
+    latency:    few concurrent requests, each inference may use many cores
+    throughput: one core per request, many requests in parallel
+    balanced:   in between (default)
+
+The budget is for the whole box and is split between processes: when a model
+server is in use (MODEL_SERVER_ADDRESS) it gets MODEL_SERVER_CPU_BUDGET cores
+(default: half), and the remaining cores are divided evenly among the
+EXECUTION_PROCESSES web workers (gunicorn.conf.py sets this to its worker count).
+
+Environment overrides (all optional):
+    EXECUTION_PROFILE, CPU_BUDGET, EXECUTION_PROCESSES, MODEL_SERVER_CPU_BUDGET,
+    TF_INTRA_OP_THREADS, TF_INTER_OP_THREADS, OPENCV_THREADS, REQUEST_THREADS
+"""
+
+import os
+
+import cv2
+
+DEFAULT_PROFILE = 'balanced'
+ROLE_WEB = 'web'
+ROLE_MODEL_SERVER = 'model_server'
+
+def _available_cores():
+    """Return the number of cores this process may run on."""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+def _profile_settings(profile, cores):
+    """Return thread counts for a profile given a CPU budget."""
+    if profile == 'latency':
+        return {
+            'request_threads': min(2, cores),
+            'tf_intra_op_threads': max(1, cores // 2),
+            'tf_inter_op_threads': 1,
+            'opencv_threads': max(1, cores // 2)
+        }
+    if profile == 'throughput':
+        return {
+            'request_threads': cores,
+            'tf_intra_op_threads': 1,
+            'tf_inter_op_threads': 1,
+            'opencv_threads': 1
+        }
+    if profile == 'balanced':
+        return {
+            'request_threads': max(2, cores // 2),
+            'tf_intra_op_threads': min(2, cores),
+            'tf_inter_op_threads': 1,
+            'opencv_threads': 1
+        }
+    raise ValueError(f"Unknown execution profile '{profile}'. Use: latency, throughput, balanced")
+
+def _process_budget(role, total):
+    """Return this process's share of the total CPU budget."""
+    model_server_cores = 0
+    if role == ROLE_MODEL_SERVER or os.environ.get('MODEL_SERVER_ADDRESS'):
+        model_server_cores = int(os.environ.get('MODEL_SERVER_CPU_BUDGET', 0)) or max(1, total // 2)
+        model_server_cores = min(model_server_cores, max(1, total - 1))
+    if role == ROLE_MODEL_SERVER:
+        return model_server_cores
+
+    processes = max(1, int(os.environ.get('EXECUTION_PROCESSES', 1)))
+    return max(1, (total - model_server_cores) // processes)
+
+def get_execution_config(profile=None, role=ROLE_WEB):
+    """
+    Resolve this process's execution configuration from the profile and environment.
+
+    Args:
+        profile (str): Profile name (default: EXECUTION_PROFILE env or 'balanced')
+        role (str): ROLE_WEB for request-serving workers, ROLE_MODEL_SERVER for
+            the shared model server
+
+    Returns:
+        dict: profile, role, cpu_budget (total), process_budget and per-pool thread counts
+    """
+    profile = profile or os.environ.get('EXECUTION_PROFILE', DEFAULT_PROFILE)
+    total = int(os.environ.get('CPU_BUDGET', 0)) or _available_cores()
+    cores = _process_budget(role, total)
+
+    config = {'profile': profile, 'role': role, 'cpu_budget': total, 'process_budget': cores}
+    if role == ROLE_MODEL_SERVER:
+        # One batching thread runs inference; give it all of the server's cores
+        config.update({'request_threads': 1, 'tf_intra_op_threads': cores,
+                       'tf_inter_op_threads': 1, 'opencv_threads': 1})
+    else:
+        config.update(_profile_settings(profile, cores))
+
+    overrides = {
+        'tf_intra_op_threads': 'TF_INTRA_OP_THREADS',
+        'tf_inter_op_threads': 'TF_INTER_OP_THREADS',
+        'opencv_threads': 'OPENCV_THREADS',
+        'request_threads': 'REQUEST_THREADS'
+    }
+    for key, env_name in overrides.items():
+        if os.environ.get(env_name):
+            config[key] = int(os.environ[env_name])
+
+    return config
+
+_applied_config = None
+
+def apply_execution_config(profile=None, role=None):
+    """
+    Apply thread settings for OpenCV and (pre-load) TensorFlow.
+
+    Must run before TensorFlow initializes its runtime; face_emotions calls it
+    at import and again right after importing TensorFlow.
+
+    Returns:
+        dict: The applied configuration
+    """
+    global _applied_config
+    if _applied_config is not None and profile is None and role is None:
+        return _applied_config
+
+    config = get_execution_config(profile, role or ROLE_WEB)
+
+    cv2.setNumThreads(config['opencv_threads'])
+
+    # Read by the TensorFlow runtime (and its OpenMP/oneDNN kernels) at init
+    os.environ['TF_NUM_INTRAOP_THREADS'] = str(config['tf_intra_op_threads'])
+    os.environ['TF_NUM_INTEROP_THREADS'] = str(config['tf_inter_op_threads'])
+    os.environ.setdefault('OMP_NUM_THREADS', str(config['tf_intra_op_threads']))
+
+    _applied_config = config
+    return config
+
+def configure_tensorflow(tf):
+    """
+    Pin TensorFlow's thread pools; call after importing TF, before loading a model.
+
+    Args:
+        tf (module): The imported tensorflow module
+    """
+    config = apply_execution_config()
+    try:
+        tf.config.threading.set_intra_op_parallelism_threads(config['tf_intra_op_threads'])
+        tf.config.threading.set_inter_op_parallelism_threads(config['tf_inter_op_threads'])
+    except RuntimeError as e:
+        # Runtime already initialized; the env vars above still applied at init
+        print(f"TensorFlow thread pools already initialized: {e}")
+
+def get_request_threads():
+    """Return this process's request worker pool size for the active configuration."""
+    return apply_execution_config()['request_threads']
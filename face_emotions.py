@@ -5,8 +5,13 @@ Detects emotions from facial expressions in images/frames using a pre-trained CN
 
 import cv2
 import numpy as np
-from tensorflow.keras.models import load_model # pyright: ignore[reportMissingImports]
 import os
+import threading
+import time
+
+from execution_config import apply_execution_config, configure_tensorflow
+from preprocessing import get_arena
+from model_registry import load_registry, select_variant, next_cheaper
 
 # Configuration
 MODEL_PATH = 'face_emotions_model.h5'
@@ -15,26 +20,302 @@ CASCADE_PATH = cv2.data.haarcascades + 'haarcascade_frontalface_default.xml' # p
 # Emotion labels (7 classes)
 EMOTION_LABELS = ['Angry', 'Disgust', 'Fear', 'Happy', 'Sad', 'Surprise', 'Neutral']
 FACE_SIZE = 48
+WARMUP_BATCH_SIZE = 8
+
+# Per-frame latency budget (ms). When set and model_registry.json lists
+# variants, the most accurate variant that fits is loaded, and the server
+# degrades to cheaper variants automatically when measured latency overruns.
+LATENCY_BUDGET_MS = float(os.environ.get('LATENCY_BUDGET_MS', 0)) or None
+LATENCY_EWMA_ALPHA = 0.1
+LATENCY_MIN_SAMPLES = 20
+# Only request-sized calls (one frame's faces) are compared with the per-frame
+# budget; bulk batches such as offline video analysis are not
+LATENCY_MAX_FACES = 8
+UPGRADE_COOLDOWN_SECONDS = 60.0
+
+# When set, inference is delegated to a shared model server process
+# (see model_server.py) and this process never loads TensorFlow.
+MODEL_SERVER_ADDRESS = os.environ.get('MODEL_SERVER_ADDRESS')
+
+# Thread budgets must be in place before OpenCV/TensorFlow spin up their pools
+apply_execution_config()
+
+# TensorFlow and the model are loaded lazily on first use (or by the
+# background warm-up) so importing this module never blocks a worker.
+model = None
+_model_lock = threading.Lock()
+# CascadeClassifier is not thread-safe, so every thread loads its own
+_cascade_local = threading.local()
+_warmup_lock = threading.Lock()
+_variant_lock = threading.Lock()
+_model_load_attempted = False
+_model_client = None
+_warmup_thread = None
+_active_variant = None
+_variant_state = {
+    'latency_ewma_ms': None,
+    'samples': 0,
+    'switching': False,
+    'last_switch': 0.0,
+    'cheaper': None,        # downgrade target for the active variant
+    'best': None            # upgrade target, if better than the active variant
+}
+_warmup_state = {
+    'status': 'idle',       # idle -> loading -> warming -> ready | error
+    'error': None,
+    'load_seconds': None,
+    'warmup_seconds': None
+}
+
+def _load_model(path=MODEL_PATH):
+    """
+    Import TensorFlow, pin its thread pools and load a model (default: MODEL_PATH).
+    
+    The /255 rescale is folded into the loaded graph so uint8 crops go in directly.
+    """
+    import tensorflow as tf # pyright: ignore[reportMissingImports]
+    configure_tensorflow(tf)
+    from model import fold_rescaling
+    return fold_rescaling(tf.keras.models.load_model(path), FACE_SIZE)
+
+def get_model():
+    """
+    Return the emotion model, loading it on first call.
+    
+    Returns:
+        Model or None: Loaded Keras model, or None if loading failed
+    """
+    global model, _model_load_attempted, _active_variant
+    if model is not None or _model_load_attempted:
+        return model
+    
+    with _model_lock:
+        if model is None and not _model_load_attempted:
+            path = MODEL_PATH
+            variants = load_registry() if LATENCY_BUDGET_MS else []
+            variant = select_variant(LATENCY_BUDGET_MS, variants) if variants else None
+            if variant is not None:
+                path = variant['path']
+            try:
+                start = time.perf_counter()
+                model = _load_model(path)
+                _active_variant = variant['name'] if variant else None
+                if variant is not None:
+                    _refresh_variant_targets(variants)
+                # Loaded lazily by a request (MODEL_WARMUP=False) rather than by warm_up()
+                if _warmup_state['status'] == 'idle':
+                    _warmup_state.update({'status': 'ready', 'load_seconds': round(time.perf_counter() - start, 3)})
+            except Exception as e:
+                print(f"Error loading model from {path}: {e}")
+                model = None
+            finally:
+                _model_load_attempted = True
+    return model
+
+def _refresh_variant_targets(variants=None):
+    """
+    Work out the downgrade/upgrade targets for the active variant.
+    
+    Runs once per load or switch, so the per-inference check in
+    record_inference_latency never reads the registry file.
+    """
+    variants = load_registry() if variants is None else variants
+    best = select_variant(LATENCY_BUDGET_MS, variants)
+    _variant_state['cheaper'] = next_cheaper(_active_variant, variants)
+    _variant_state['best'] = best if best is not None and best['name'] != _active_variant else None
+
+def _switch_variant(variant):
+    """Load and warm a variant in the background, then make it the active model."""
+    global model, _active_variant
+    try:
+        candidate = _load_model(variant['path'])
+        for size in (1, WARMUP_BATCH_SIZE):
+            candidate.predict(np.zeros((size, FACE_SIZE, FACE_SIZE, 1), dtype=np.uint8), verbose=0)
+        with _model_lock:
+            print(f"Switching model variant {_active_variant} -> {variant['name']}")
+            model = candidate
+            _active_variant = variant['name']
+            with _variant_lock:
+                _variant_state.update({'latency_ewma_ms': None, 'samples': 0, 'last_switch': time.monotonic()})
+                _refresh_variant_targets()
+    except Exception as e:
+        print(f"Error switching to model variant {variant['name']}: {e}")
+    finally:
+        with _variant_lock:
+            _variant_state['switching'] = False
+
+def record_inference_latency(latency_ms, faces=1):
+    """
+    Feed one request's model.predict() latency into the variant selector.
+    
+    The registry's latency_ms is single-face predict() time, so samples are
+    per-request (a frame's faces); calls over LATENCY_MAX_FACES are ignored.
+    Sustained latency over LATENCY_BUDGET_MS degrades to the next cheaper
+    variant; sustained headroom (after a cooldown) moves back up to the best
+    variant that fits the budget.
+    
+    Args:
+        latency_ms (float): Inference time attributable to the request
+        faces (int): Faces in the request
+    """
+    if not LATENCY_BUDGET_MS or _active_variant is None or faces > LATENCY_MAX_FACES:
+        return
+    
+    with _variant_lock:
+        ewma = _variant_state['latency_ewma_ms']
+        ewma = latency_ms if ewma is None else ewma + LATENCY_EWMA_ALPHA * (latency_ms - ewma)
+        _variant_state['latency_ewma_ms'] = ewma
+        _variant_state['samples'] += 1
+        if _variant_state['switching'] or _variant_state['samples'] < LATENCY_MIN_SAMPLES:
+            return
+        
+        target = None
+        if ewma > LATENCY_BUDGET_MS:
+            target = _variant_state['cheaper']
+        elif (ewma < LATENCY_BUDGET_MS / 2
+              and time.monotonic() - _variant_state['last_switch'] > UPGRADE_COOLDOWN_SECONDS):
+            target = _variant_state['best']
+        
+        if target is None:
+            return
+        _variant_state['switching'] = True
+    
+    threading.Thread(target=_switch_variant, args=(target,), name='model-switch', daemon=True).start()
+
+def get_face_cascade():
+    """
+    Return the calling thread's Haar cascade face detector, loading it on first use.
+    
+    A single CascadeClassifier shared between threads fails detectMultiScale
+    calls at random (and silently loses faces), so each thread gets its own.
+    """
+    cascade = getattr(_cascade_local, 'cascade', None)
+    if cascade is not None:
+        return cascade
+    
+    try:
+        cascade = cv2.CascadeClassifier(CASCADE_PATH)
+        if cascade.empty():
+            raise RuntimeError(f'Failed to load Haar cascade from {CASCADE_PATH}')
+        _cascade_local.cascade = cascade
+        return cascade
+    except Exception as e:
+        print(f"Error loading face cascade: {e}")
+        return None
+
+def _get_model_client():
+    """Return the model server client, creating it on first call."""
+    global _model_client
+    if _model_client is None:
+        from model_server import ModelServerClient
+        _model_client = ModelServerClient(MODEL_SERVER_ADDRESS)
+    return _model_client
+
+def predict_faces(faces):
+    """
+    Run a batch of preprocessed faces through the model.
+    
+    Args:
+        faces (np.ndarray): uint8 crops shaped (N, FACE_SIZE, FACE_SIZE, 1);
+            the model rescales internally
+    
+    Returns:
+        np.ndarray: Class probabilities shaped (N, len(EMOTION_LABELS))
+    """
+    if MODEL_SERVER_ADDRESS:
+        # Sent as-is: uint8 crops are 4x smaller on the wire than float32
+        return _get_model_client().predict(faces)
+    
+    start = time.perf_counter()
+    predictions = get_model().predict(to_model_input(faces), verbose=0) # pyright: ignore[reportOptionalMemberAccess]
+    record_inference_latency((time.perf_counter() - start) * 1000, len(faces))
+    return predictions
+
+def to_model_input(faces):
+    """
+    Return a batch on the model's 0-255 input scale.
+    
+    uint8 crops pass through untouched; float batches are assumed to be
+    [0, 1]-normalized (the old input contract) and scaled back up.
+    """
+    if faces.dtype == np.uint8:
+        return faces
+    return faces * 255.0
+
+def reset_after_fork():
+    """Drop per-process state inherited from a preloading parent process."""
+    global _model_client, _warmup_thread
+    _model_client = None
+    _warmup_thread = None
+    _warmup_state.update({'status': 'idle', 'error': None, 'load_seconds': None, 'warmup_seconds': None})
+
+def warm_up(batch_size=WARMUP_BATCH_SIZE):
+    """
+    Load the model and run dummy batches so the first real request
+    doesn't pay TensorFlow graph-tracing costs.
+    
+    Args:
+        batch_size (int): Size of the multi-face dummy batch
+    
+    Returns:
+        bool: True if inference is ready
+    """
+    try:
+        _warmup_state['status'] = 'loading'
+        start = time.perf_counter()
+        cascade = get_face_cascade()
+        if MODEL_SERVER_ADDRESS:
+            loaded = _get_model_client() if _get_model_client().ping() else None
+        else:
+            loaded = get_model()
+        _warmup_state['load_seconds'] = round(time.perf_counter() - start, 3)
+        
+        if loaded is None or cascade is None:
+            _warmup_state['status'] = 'error'
+            _warmup_state['error'] = 'Model or cascade not available'
+            return False
+        
+        _warmup_state['status'] = 'warming'
+        start = time.perf_counter()
+        # Trace both the single-face shape used per request and a larger batch
+        for size in (1, batch_size):
+            dummy = np.zeros((size, FACE_SIZE, FACE_SIZE, 1), dtype=np.uint8)
+            predict_faces(dummy)
+        # Tracing-inflated warm-up timings must not count against the latency budget
+        with _variant_lock:
+            _variant_state.update({'latency_ewma_ms': None, 'samples': 0})
+        _warmup_state['warmup_seconds'] = round(time.perf_counter() - start, 3)
+        _warmup_state['status'] = 'ready'
+        return True
+        
+    except Exception as e:
+        print(f"Error warming up model: {e}")
+        _warmup_state['status'] = 'error'
+        _warmup_state['error'] = str(e)
+        return False
 
-# Load model once at module import
-try:
-    model = load_model(MODEL_PATH)
-except Exception as e:
-    print(f"Error loading model from {MODEL_PATH}: {e}")
-    model = None
-
-# Load Haar Cascade for face detection
-try:
-    face_cascade = cv2.CascadeClassifier(CASCADE_PATH)
-    if face_cascade.empty():
-        raise RuntimeError(f'Failed to load Haar cascade from {CASCADE_PATH}')
-except Exception as e:
-    print(f"Error loading face cascade: {e}")
-    face_cascade = None
+def start_background_warmup():
+    """Start model loading and warm-up in a daemon thread (idempotent)."""
+    global _warmup_thread
+    with _warmup_lock:
+        if _warmup_thread is None:
+            _warmup_thread = threading.Thread(target=warm_up, name='model-warmup', daemon=True)
+            _warmup_thread.start()
+    return _warmup_thread
+
+def is_model_ready():
+    """Check if the model has been loaded and warmed up."""
+    return _warmup_state['status'] == 'ready'
+
+def get_readiness():
+    """Return a copy of the warm-up state for readiness reporting."""
+    return dict(_warmup_state)
 
 def is_model_available():
-    """Check if model is loaded and available."""
-    return model is not None and face_cascade is not None
+    """Check if model is loaded and available (loads lazily if needed)."""
+    if MODEL_SERVER_ADDRESS:
+        return get_face_cascade() is not None
+    return get_model() is not None and get_face_cascade() is not None
 
 def detect_emotion(frame, draw_box=True):
     """
@@ -47,45 +328,100 @@ def detect_emotion(frame, draw_box=True):
     Returns:
         str: Detected emotion label (or 'No Face Detected' / 'Error' if failed)
     """
+    emotion, _ = detect_emotion_with_confidence(frame, draw_box)
+    return emotion
+
+def detect_emotion_with_confidence(frame, draw_box=True):
+    """
+    Detect emotion in a frame and return it with the model's confidence.
+    
+    Args:
+        frame (np.ndarray): Input image frame (BGR format from OpenCV)
+        draw_box (bool): Whether to draw bounding box and label on frame (in-place)
+    
+    Returns:
+        tuple: (emotion_label, confidence_score); confidence is 0.0 on failure
+    """
+    emotion, confidence, _ = detect_emotion_with_face(frame, draw_box)
+    return emotion, confidence
+
+def detect_emotion_with_face(frame, draw_box=True):
+    """
+    Detect emotion in a frame and also return the face box that was used.
+    
+    Returns:
+        tuple: (emotion_label, confidence_score, (x, y, w, h) or None)
+    """
     
     if not is_model_available():
         print("Model or cascade not available")
-        return "Error"
+        return "Error", 0.0, None
     
     try:
         # Validate input
         if frame is None or not isinstance(frame, np.ndarray):
             print("Invalid frame input")
-            return "Error"
+            return "Error", 0.0, None
         
         if frame.size == 0:
             print("Empty frame")
-            return "Error"
+            return "Error", 0.0, None
         
-        # Convert to grayscale
-        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        # Convert to grayscale (into this thread's reusable buffer)
+        gray = get_arena().to_gray(frame)
         
-        # Try multiple detection strategies for robustness
-        faces = _detect_faces_multi_strategy(gray)
-        
-        if len(faces) == 0:
+        emotion, confidence, face = _detect_emotion_in_gray(gray)
+        if face is None:
             print("No faces detected in frame")
-            return "No Face Detected"
-        
-        # Process first detected face
-        emotion, confidence = _predict_emotion_for_face(faces[0], gray)
         
         # Draw on frame if requested
-        if draw_box and len(faces) > 0:
-            _annotate_frame(frame, faces[0], emotion)
+        if draw_box and face is not None:
+            annotate_frame(frame, face, emotion)
         
-        return emotion
+        return emotion, confidence, face
         
     except Exception as e:
         print(f"Error in detect_emotion: {e}")
-        return "Error"
+        return "Error", 0.0, None
+
+def detect_emotion_gray(gray):
+    """
+    Detect emotion in an already-grayscale frame (e.g. streamed from a browser).
+    
+    Args:
+        gray (np.ndarray): 2-D uint8 grayscale image
+    
+    Returns:
+        tuple: (emotion_label, confidence_score, face_coords or None)
+    """
+    if not is_model_available():
+        print("Model or cascade not available")
+        return "Error", 0.0, None
+    
+    try:
+        if gray is None or not isinstance(gray, np.ndarray) or gray.ndim != 2 or gray.size == 0:
+            print("Invalid grayscale frame input")
+            return "Error", 0.0, None
+        
+        return _detect_emotion_in_gray(gray)
+        
+    except Exception as e:
+        print(f"Error in detect_emotion_gray: {e}")
+        return "Error", 0.0, None
 
-def _detect_faces_multi_strategy(gray_image):
+def _detect_emotion_in_gray(gray):
+    """Run face detection and prediction on a grayscale image."""
+    # Try multiple detection strategies for robustness
+    faces = detect_faces(gray)
+    
+    if len(faces) == 0:
+        return "No Face Detected", 0.0, None
+    
+    # Process first detected face
+    emotion, confidence = _predict_emotion_for_face(faces[0], gray)
+    return emotion, confidence, tuple(int(v) for v in faces[0])
+
+def _detect_faces_multi_strategy(cascade, gray_image):
     """
     Try multiple detection strategies to improve robustness.
     Returns list of detected faces as (x, y, w, h) tuples.
@@ -93,7 +429,7 @@ def _detect_faces_multi_strategy(gray_image):
     attempts = []
     
     # Strategy 1: Histogram equalization with tight parameters
-    gray_eq = cv2.equalizeHist(gray_image)
+    gray_eq = get_arena().equalize(gray_image)
     attempts.append({
         'img': gray_eq,
         'scaleFactor': 1.1,
@@ -120,7 +456,7 @@ def _detect_faces_multi_strategy(gray_image):
     faces = ()
     for attempt in attempts:
         try:
-            faces = face_cascade.detectMultiScale( # pyright: ignore[reportOptionalMemberAccess]
+            faces = cascade.detectMultiScale(
                 attempt['img'],
                 scaleFactor=attempt['scaleFactor'],
                 minNeighbors=attempt['minNeighbors'],
@@ -134,6 +470,45 @@ def _detect_faces_multi_strategy(gray_image):
     
     return faces
 
+def detect_faces(gray_image):
+    """
+    Detect faces in a grayscale image.
+    
+    Returns:
+        Sequence of (x, y, w, h) face coordinates (empty if none or unavailable)
+    """
+    cascade = get_face_cascade()
+    if cascade is None:
+        return ()
+    return _detect_faces_multi_strategy(cascade, gray_image)
+
+def extract_face(gray_image, face_coords):
+    """
+    Crop and resize a face to the model input size.
+    
+    Args:
+        gray_image (np.ndarray): Grayscale image
+        face_coords (tuple): Face coordinates (x, y, w, h)
+    
+    Returns:
+        np.ndarray or None: uint8 crop shaped (FACE_SIZE, FACE_SIZE, 1)
+    """
+    x, y, w, h = face_coords
+    face_roi = gray_image[y:y+h, x:x+w]
+    if face_roi.size == 0:
+        return None
+    return cv2.resize(face_roi, (FACE_SIZE, FACE_SIZE))[..., np.newaxis]
+
+def labels_from_predictions(predictions):
+    """
+    Convert a batch of model outputs into labels and confidences.
+    
+    Returns:
+        list: [(emotion_label, confidence_score), ...] in batch order
+    """
+    indices = np.argmax(predictions, axis=1)
+    return [(EMOTION_LABELS[int(i)], float(predictions[row, i])) for row, i in enumerate(indices)]
+
 def _predict_emotion_for_face(face_coords, gray_image):
     """
     Predict emotion for a detected face region.
@@ -146,25 +521,15 @@ def _predict_emotion_for_face(face_coords, gray_image):
         tuple: (emotion_label, confidence_score)
     """
     try:
-        x, y, w, h = face_coords
-        
-        # Extract face region
-        face_roi = gray_image[y:y+h, x:x+w]
+        # Crop and resize straight into this thread's uint8 batch buffer;
+        # the model applies the /255 rescale itself
+        face_input = get_arena().face_batch(gray_image, [face_coords])
         
-        if face_roi.size == 0:
+        if face_input is None:
             return "Error", 0.0
         
-        # Resize to model input size
-        face_resized = cv2.resize(face_roi, (FACE_SIZE, FACE_SIZE))
-        
-        # Normalize to [0, 1]
-        face_normalized = face_resized.astype('float32') / 255.0
-        
-        # Reshape for model: (1, 48, 48, 1)
-        face_input = np.expand_dims(face_normalized, axis=(0, -1))
-        
         # Predict
-        predictions = model.predict(face_input, verbose=0) # pyright: ignore[reportOptionalMemberAccess]
+        predictions = predict_faces(face_input)
         confidence = float(np.max(predictions[0]))
         emotion_idx = int(np.argmax(predictions[0]))
         emotion_label = EMOTION_LABELS[emotion_idx]
@@ -175,7 +540,7 @@ def _predict_emotion_for_face(face_coords, gray_image):
         print(f"Error predicting emotion: {e}")
         return "Error", 0.0
 
-def _annotate_frame(frame, face_coords, emotion):
+def annotate_frame(frame, face_coords, emotion):
     """
     Annotate frame with face bounding box and emotion label.
     Modifies frame in-place.
@@ -221,6 +586,15 @@ def get_emotion_labels():
 
 def get_model_info():
     """Return information about the loaded model."""
+    if MODEL_SERVER_ADDRESS:
+        return {
+            'status': 'remote',
+            'model_server': MODEL_SERVER_ADDRESS,
+            'emotions': EMOTION_LABELS,
+            'num_emotions': len(EMOTION_LABELS),
+            'face_size': FACE_SIZE
+        }
+    
     if model is None:
         return {'status': 'error', 'message': 'Model not loaded'}
     
@@ -228,6 +602,9 @@ def get_model_info():
         return {
             'status': 'loaded',
             'model_path': MODEL_PATH,
+            'variant': _active_variant,
+            'latency_budget_ms': LATENCY_BUDGET_MS,
+            'latency_ewma_ms': _variant_state['latency_ewma_ms'],
             'emotions': EMOTION_LABELS,
             'num_emotions': len(EMOTION_LABELS),
             'face_size': FACE_SIZE,
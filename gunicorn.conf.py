@@ -0,0 +1,87 @@
+"""
+Gunicorn configuration for the Emotion Detection app.
+
+SERVING_MODE selects how workers get at the model:
+    model_server (default): one spawned model-server process owns TensorFlow and
+        the weights; workers send face crops to it over a Unix socket.
+    per_worker: every worker loads its own copy of the model (original behaviour).
+
+The app itself is preloaded in the master so application code and OpenCV are
+shared copy-on-write across workers. (Each thread loads its own Haar cascade,
+since a CascadeClassifier is not thread-safe.)
+
+Thread pools are sized by execution_config.py (EXECUTION_PROFILE=latency |
+throughput | balanced) from one CPU budget split between the model server and
+the workers, so every process gets its own share rather than the whole box.
+
+Usage:
+    gunicorn app:app            (picks up this file automatically)
+"""
+
+import os
+
+
+SERVING_MODE = os.environ.get('SERVING_MODE', 'model_server')
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+preload_app = True
+
+# Must be set before app.py is imported (preload happens before on_starting)
+# so face_emotions picks up the model-server address and the master never
+# starts TensorFlow itself. The address and worker count also decide how
+# execution_config splits the CPU budget between processes.
+os.environ['MODEL_WARMUP'] = 'False'
+if SERVING_MODE == 'model_server':
+    os.environ.setdefault('MODEL_SERVER_ADDRESS', '/tmp/emotion_model_server.sock')
+os.environ['EXECUTION_PROCESSES'] = str(workers)
+
+# Admission control admits the worker's share of the CPU budget (request_threads)
+# and queues the rest itself; gthread gets enough threads for every admitted and
+# queued request, so excess load is queued or shed there instead of piling up
+# unbounded in gthread's own executor queue. (Imported only now: the limits
+# depend on the environment set above.)
+from admission import serving_threads, ACCEPT_BACKLOG
+
+worker_class = 'gthread'
+threads = serving_threads()
+# gthread queues accepted connections for its pool without limit up to
+# worker_connections; keep that queue short so overload is refused early
+worker_connections = threads + ACCEPT_BACKLOG
+
+_model_server_process = None
+_storage_manager_process = None
+
+def on_starting(server):
+    """Start the shared model server; check the cascade loads before forking workers."""
+    global _model_server_process, _storage_manager_process
+    import face_emotions
+    from storage_manager import start_storage_manager_process, MANAGER_INTERVAL
+
+    face_emotions.get_face_cascade()
+
+    if SERVING_MODE == 'model_server':
+        from model_server import start_model_server_process, get_authkey
+        get_authkey()  # exported via os.environ so forked workers share it
+        _model_server_process = start_model_server_process(os.environ['MODEL_SERVER_ADDRESS'])
+        # Supervised: a model server that dies is restarted without restarting gunicorn
+        server.log.info(f"Model server started (supervisor pid {_model_server_process.pid})")
+
+    # Storage passes get their own process: no thread is alive in the master when it forks
+    if MANAGER_INTERVAL > 0:
+        _storage_manager_process = start_storage_manager_process(MANAGER_INTERVAL)
+        server.log.info(f"Storage manager started (pid {_storage_manager_process.pid})")
+
+def post_fork(server, worker):
+    """Reset inherited state and warm up inference in each worker."""
+    import face_emotions
+
+    face_emotions.reset_after_fork()
+    face_emotions.start_background_warmup()
+
+def on_exit(server):
+    """Stop the model server and storage manager with the master."""
+    for process in (_model_server_process, _storage_manager_process):
+        if process is not None and process.is_alive():
+            process.terminate()
+            process.join(timeout=10)
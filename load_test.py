@@ -0,0 +1,390 @@
+"""
+Load Test Harness
+Starts the app locally and replays a mixed, seeded workload against it at rising
+concurrency, reporting per-endpoint throughput, latency percentiles and error
+rates so serving changes can be compared on real numbers.
+
+The workload mixes /upload (multipart), /capture (base64 frames), /api/history,
+/api/statistics and /api/emotion polling using synthetic face images. With
+--rate the schedule is open-loop: latency is measured from each request's
+scheduled start, so queueing inside the server shows up instead of being hidden
+by slower clients.
+
+Usage:
+    python load_test.py
+    python load_test.py --server gunicorn --concurrency 1,8,32 --duration 30
+    python load_test.py --rate 50 --mix upload=1,capture=4,emotion=10 --output run.json
+    python load_test.py --url http://localhost:5000     (use an already running server)
+"""
+
+import argparse
+import base64
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+
+import cv2
+import numpy as np
+import requests
+
+# Configuration
+DEFAULT_MIX = 'upload=1,capture=3,history=2,statistics=1,emotion=8'
+DEFAULT_CONCURRENCY = '1,4,16'
+DEFAULT_DURATION = 20
+DEFAULT_IMAGES = 16
+IMAGE_SIZE = 320
+STARTUP_TIMEOUT = 180
+REQUEST_TIMEOUT = 30
+# Responses the admission controller sheds on purpose; reported apart from errors
+SHED_STATUSES = (429, 503)
+
+SERVER_COMMANDS = {
+    'flask': lambda port: [sys.executable, 'app.py'],
+    'gunicorn': lambda port: ['gunicorn', 'app:app'],
+    'asgi': lambda port: [sys.executable, '-m', 'uvicorn', 'asgi:app', '--host', '127.0.0.1', '--port', str(port)]
+}
+
+def synthetic_faces(count=DEFAULT_IMAGES, size=IMAGE_SIZE, seed=0):
+    """
+    Draw simple synthetic face images with varied pose, expression and lighting.
+
+    Returns:
+        list: JPEG-encoded images (bytes)
+    """
+    rng = np.random.default_rng(seed)
+    images = []
+    for _ in range(count):
+        background = int(rng.integers(40, 200))
+        image = np.full((size, size, 3), background, dtype=np.uint8)
+        image = cv2.add(image, rng.integers(0, 25, image.shape, dtype=np.uint8))
+
+        cx = size // 2 + int(rng.integers(-size // 10, size // 10))
+        cy = size // 2 + int(rng.integers(-size // 10, size // 10))
+        w = int(size * rng.uniform(0.22, 0.3))
+        h = int(w * 1.3)
+        skin = tuple(int(v) for v in rng.integers(120, 230, 3))
+        cv2.ellipse(image, (cx, cy), (w, h), 0, 0, 360, skin, -1)
+
+        # Eyes, brows and a mouth whose curve varies the "expression"
+        eye_y = cy - h // 4
+        for side in (-1, 1):
+            ex = cx + side * w // 2
+            cv2.ellipse(image, (ex, eye_y), (w // 6, w // 10), 0, 0, 360, (255, 255, 255), -1)
+            cv2.circle(image, (ex, eye_y), w // 14, (30, 30, 30), -1)
+            tilt = int(rng.integers(-w // 10, w // 10))
+            cv2.line(image, (ex - w // 5, eye_y - w // 4 + side * tilt), (ex + w // 5, eye_y - w // 4 - side * tilt),
+                     (40, 40, 40), max(2, w // 25))
+        mouth_y = cy + h // 2
+        curve = int(rng.integers(-w // 4, w // 4))
+        start, end = (0, 180) if curve >= 0 else (180, 360)
+        cv2.ellipse(image, (cx, mouth_y), (w // 3, max(2, abs(curve))), 0, start, end, (60, 30, 120), max(2, w // 20))
+
+        image = cv2.GaussianBlur(image, (3, 3), 0)
+        success, encoded = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, 90])
+        if success:
+            images.append(encoded.tobytes())
+    return images
+
+def parse_mix(spec):
+    """Parse 'endpoint=weight,...' into a dict of weights."""
+    mix = {}
+    for part in spec.split(','):
+        name, _, weight = part.partition('=')
+        name = name.strip()
+        if name not in ENDPOINTS:
+            raise ValueError(f"Unknown endpoint '{name}' (choose from {', '.join(ENDPOINTS)})")
+        mix[name] = float(weight or 1)
+    return mix
+
+class Workload:
+    """Issues one request per call; all state needed to replay a run comes from the seed."""
+
+    def __init__(self, base_url, images, users):
+        self.base_url = base_url.rstrip('/')
+        self.images = images
+        self.data_urls = ['data:image/jpeg;base64,' + base64.b64encode(img).decode('ascii') for img in images]
+        self.users = users
+
+    def upload(self, session, rng):
+        index = rng.randrange(len(self.images))
+        return session.post(f'{self.base_url}/upload',
+                            files={'file': (f'face_{index}.jpg', self.images[index], 'image/jpeg')},
+                            data={'user_name': rng.choice(self.users)}, timeout=REQUEST_TIMEOUT)
+
+    def capture(self, session, rng):
+        return session.post(f'{self.base_url}/capture',
+                            json={'user_name': rng.choice(self.users), 'image': rng.choice(self.data_urls)},
+                            timeout=REQUEST_TIMEOUT)
+
+    def history(self, session, rng):
+        params = {'limit': 20}
+        if rng.random() < 0.5:
+            params['user_name'] = rng.choice(self.users)
+        return session.get(f'{self.base_url}/api/history', params=params, timeout=REQUEST_TIMEOUT)
+
+    def statistics(self, session, rng):
+        params = {'user_name': rng.choice(self.users)} if rng.random() < 0.5 else {}
+        return session.get(f'{self.base_url}/api/statistics', params=params, timeout=REQUEST_TIMEOUT)
+
+    def emotion(self, session, rng):
+        return session.get(f'{self.base_url}/api/emotion', timeout=REQUEST_TIMEOUT)
+
+ENDPOINTS = {
+    'upload': Workload.upload,
+    'capture': Workload.capture,
+    'history': Workload.history,
+    'statistics': Workload.statistics,
+    'emotion': Workload.emotion
+}
+
+class Results:
+    """Thread-safe per-endpoint latency and status collection."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.statuses = defaultdict(lambda: defaultdict(int))
+
+    def record(self, endpoint, status, latency):
+        with self._lock:
+            self.statuses[endpoint][status] += 1
+            if isinstance(status, int) and 200 <= status < 300:
+                self.latencies[endpoint].append(latency)
+
+    def summary(self, elapsed):
+        """Per-endpoint (and total) throughput, latency percentiles and error rates."""
+        rows = {}
+        with self._lock:
+            endpoints = sorted(self.statuses)
+            for endpoint in endpoints + ['total']:
+                if endpoint == 'total':
+                    latencies = [l for e in endpoints for l in self.latencies[e]]
+                    statuses = defaultdict(int)
+                    for e in endpoints:
+                        for status, n in self.statuses[e].items():
+                            statuses[status] += n
+                else:
+                    latencies = self.latencies[endpoint]
+                    statuses = self.statuses[endpoint]
+
+                requests_made = sum(statuses.values())
+                ok = sum(n for s, n in statuses.items() if isinstance(s, int) and 200 <= s < 300)
+                shed = sum(n for s, n in statuses.items() if s in SHED_STATUSES)
+                values = np.array(latencies) * 1000 if latencies else None
+                rows[endpoint] = {
+                    'requests': requests_made,
+                    'throughput_rps': round(ok / elapsed, 2) if elapsed else None,
+                    'p50_ms': round(float(np.percentile(values, 50)), 1) if values is not None else None,
+                    'p90_ms': round(float(np.percentile(values, 90)), 1) if values is not None else None,
+                    'p99_ms': round(float(np.percentile(values, 99)), 1) if values is not None else None,
+                    'max_ms': round(float(values.max()), 1) if values is not None else None,
+                    'shed_rate': round(shed / requests_made, 4) if requests_made else 0.0,
+                    'error_rate': round((requests_made - ok - shed) / requests_made, 4) if requests_made else 0.0,
+                    'statuses': {str(s): n for s, n in sorted(statuses.items(), key=lambda item: str(item[0]))}
+                }
+        return rows
+
+def run_step(workload, mix, concurrency, duration, rate=None, seed=0):
+    """
+    Run the mixed workload with `concurrency` client threads for `duration` seconds.
+
+    Args:
+        rate (float): Total requests per second (open-loop); None = each client
+            sends its next request as soon as the previous one returns
+
+    Returns:
+        dict: Per-endpoint summary from Results.summary
+    """
+    names = list(mix)
+    weights = [mix[name] for name in names]
+    results = Results()
+    started = time.perf_counter()
+    stop_at = started + duration
+    slot = [0]
+    slot_lock = threading.Lock()
+
+    def next_start():
+        # Open-loop: hand out evenly spaced start times across all clients
+        with slot_lock:
+            scheduled = started + slot[0] / rate
+            slot[0] += 1
+        return scheduled
+
+    def client(index):
+        rng = random.Random(seed * 100003 + concurrency * 1009 + index)
+        session = requests.Session()
+        while True:
+            scheduled = next_start() if rate else time.perf_counter()
+            if scheduled >= stop_at:
+                break
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+
+            endpoint = rng.choices(names, weights)[0]
+            try:
+                status = ENDPOINTS[endpoint](workload, session, rng).status_code
+            except requests.RequestException as e:
+                status = type(e).__name__
+            results.record(endpoint, status, time.perf_counter() - scheduled)
+        session.close()
+
+    threads = [threading.Thread(target=client, args=(i,), daemon=True) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results.summary(time.perf_counter() - started)
+
+def find_free_port():
+    """Ask the OS for an unused TCP port."""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def start_server(server, port, data_dir, log_path=None):
+    """
+    Start the app in a subprocess on `port`.
+
+    Args:
+        server (str): 'flask' (python app.py), 'gunicorn' or 'asgi' (uvicorn)
+        data_dir (str): Directory for the server's database, uploads and
+            archive, so runs never touch the real data
+        log_path (str): File for the server's output (default: discarded)
+
+    Returns:
+        subprocess.Popen: The server process
+    """
+    env = dict(os.environ, PORT=str(port), DEBUG='False',
+               DATABASE_PATH=os.path.join(data_dir, 'emotion_detection_results.db'),
+               UPLOAD_FOLDER=os.path.join(data_dir, 'uploads'),
+               DETECTION_ARCHIVE_FOLDER=os.path.join(data_dir, 'detection_archive'))
+    if server == 'gunicorn':
+        # Keeps a run from colliding with a model server already on the default socket
+        env['MODEL_SERVER_ADDRESS'] = os.path.join(data_dir, 'model_server.sock')
+    log = open(log_path, 'wb') if log_path else subprocess.DEVNULL
+    return subprocess.Popen(SERVER_COMMANDS[server](port), env=env, stdout=log, stderr=subprocess.STDOUT,
+                            cwd=os.path.dirname(os.path.abspath(__file__)))
+
+def wait_until_ready(base_url, timeout=STARTUP_TIMEOUT, process=None):
+    """
+    Poll /ready (falling back to /health if it doesn't exist) until it returns 200.
+
+    Raises:
+        RuntimeError: If the server exits, reports that the model failed to
+            load, or doesn't become ready in time
+    """
+    path = '/ready'
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process is not None and process.poll() is not None:
+            raise RuntimeError(f"Server exited with code {process.returncode} before becoming ready")
+        try:
+            response = requests.get(base_url + path, timeout=5)
+            if response.status_code == 200:
+                return
+            if response.status_code == 404 and path == '/ready':
+                path = '/health'
+                continue
+            state = response.json() if path == '/ready' else {}
+            if isinstance(state, dict) and state.get('status') == 'error':
+                raise RuntimeError(f"Server failed to become ready: {state.get('error')}")
+        except (requests.RequestException, ValueError):
+            pass
+        time.sleep(0.5)
+    raise RuntimeError(f"Server not ready after {timeout}s ({base_url}{path})")
+
+def print_step(concurrency, summary):
+    """Print one concurrency step as a table."""
+    print(f"\nConcurrency {concurrency}")
+    print(f"{'endpoint':<12}{'reqs':>7}{'rps':>9}{'p50':>9}{'p90':>9}{'p99':>9}{'max':>9}{'shed':>8}{'err':>8}")
+    for endpoint, row in summary.items():
+        fmt = lambda v: '-' if v is None else v
+        print(f"{endpoint:<12}{row['requests']:>7}{fmt(row['throughput_rps']):>9}{fmt(row['p50_ms']):>9}"
+              f"{fmt(row['p90_ms']):>9}{fmt(row['p99_ms']):>9}{fmt(row['max_ms']):>9}"
+              f"{row['shed_rate']:>8.1%}{row['error_rate']:>8.1%}")
+
+def main():
+    """Command-line entry point."""
+    parser = argparse.ArgumentParser(description='Replay a mixed workload against the app and report latency')
+    parser.add_argument('--url', help='Target an already running server instead of starting one')
+    parser.add_argument('--server', choices=sorted(SERVER_COMMANDS), default='flask',
+                        help='How to start the app (default: flask)')
+    parser.add_argument('--server-log', help='Write the started server\'s output to this file')
+    parser.add_argument('--data-dir', help='Keep the started server\'s database and uploads here '
+                                           '(default: a temporary directory, removed afterwards)')
+    parser.add_argument('--concurrency', default=DEFAULT_CONCURRENCY,
+                        help=f'Comma-separated client counts, one step each (default: {DEFAULT_CONCURRENCY})')
+    parser.add_argument('--duration', type=float, default=DEFAULT_DURATION, help='Seconds per step')
+    parser.add_argument('--rate', type=float, default=None,
+                        help='Total requests/second per step (open-loop); default: closed-loop')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help=f'Endpoint weights (default: {DEFAULT_MIX})')
+    parser.add_argument('--users', type=int, default=8, help='Distinct user names to spread requests over')
+    parser.add_argument('--images', type=int, default=DEFAULT_IMAGES, help='Synthetic face images to generate')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for images and request mix (replayable runs)')
+    parser.add_argument('--output', help='Write the full results as JSON')
+    args = parser.parse_args()
+
+    try:
+        mix = parse_mix(args.mix)
+        levels = [int(level) for level in args.concurrency.split(',')]
+    except ValueError as e:
+        print(f"Error: {e}")
+        sys.exit(2)
+
+    process = None
+    temp_dir = None
+    base_url = args.url
+    if base_url is None:
+        port = find_free_port()
+        base_url = f'http://127.0.0.1:{port}'
+        data_dir = args.data_dir or tempfile.mkdtemp(prefix='emotion_load_test_')
+        temp_dir = None if args.data_dir else data_dir
+        print(f"Starting {args.server} server on {base_url} (data in {data_dir})...")
+        process = start_server(args.server, port, data_dir, args.server_log)
+
+    try:
+        wait_until_ready(base_url, process=process)
+        images = synthetic_faces(args.images, seed=args.seed)
+        users = [f'loadtest_user_{i}' for i in range(max(1, args.users))]
+        workload = Workload(base_url, images, users)
+
+        results = {'target': base_url, 'server': None if args.url else args.server, 'mix': mix,
+                   'duration': args.duration, 'rate': args.rate, 'seed': args.seed, 'steps': []}
+        print("=" * 80)
+        print(f"Load Test: {base_url} | mix {args.mix} | {args.duration}s per step"
+              f"{f' | {args.rate} req/s' if args.rate else ''}")
+        print("=" * 80)
+        for concurrency in levels:
+            summary = run_step(workload, mix, concurrency, args.duration, args.rate, args.seed)
+            results['steps'].append({'concurrency': concurrency, 'endpoints': summary})
+            print_step(concurrency, summary)
+        print("=" * 80)
+
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(results, f, indent=2)
+            print(f"Results written to {args.output}")
+    except Exception as e:
+        print(f"Error running load test: {e}")
+        sys.exit(1)
+    finally:
+        if process is not None:
+            process.terminate()
+            try:
+                process.wait(timeout=15)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        if temp_dir is not None:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
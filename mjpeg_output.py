@@ -0,0 +1,172 @@
+"""
+MJPEG Output Module
+Encodes frames for multipart MJPEG streaming. Frames whose pixels and
+annotations are unchanged reuse the last encoded part instead of being
+re-encoded, resize and change-detection work goes into reusable buffers, and
+JPEG quality and resolution adapt to how fast the client drains the stream.
+
+Encoded parts themselves are fresh bytes objects: WSGI servers only accept
+bytes, and the ASGI broadcaster hands one part to many viewers that may still
+be sending it, so a mutable output buffer can't be recycled between frames.
+"""
+
+import os
+import time
+
+import cv2
+import numpy as np
+
+# Configuration
+MAX_QUALITY = 85
+MIN_QUALITY = 40
+QUALITY_STEP = 10
+SCALES = (1.0, 0.75, 0.5)
+TARGET_FPS = 15.0
+# Mean absolute difference (0-255) on a 32x24 thumbnail below which a frame is "unchanged"
+CHANGE_THRESHOLD = 1.5
+UPGRADE_AFTER_FRAMES = 30
+# Threaded (WSGI) servers hold a request thread per viewer for as long as the
+# tab is open, so they cap viewers per process (the ASGI app does not)
+MAX_THREADED_VIEWERS = int(os.environ.get('MJPEG_MAX_THREADED_VIEWERS', 8))
+
+_PART_TAIL = b'\r\n'
+
+def _part_header(length):
+    return (b'--frame\r\n'
+            b'Content-Type: image/jpeg\r\n'
+            b'Content-Length: ' + str(length).encode() + b'\r\n\r\n')
+
+class MJPEGEncoder:
+    """
+    Per-stream MJPEG encoder with change detection and adaptive quality.
+
+    Call encode() with each (already annotated) frame and a hashable description
+    of what was drawn on it, and report_send_time() with how long the client
+    took to accept the previous part.
+    """
+
+    def __init__(self, max_quality=MAX_QUALITY, min_quality=MIN_QUALITY, target_fps=TARGET_FPS, adaptive=True):
+        self.max_quality = max_quality
+        self.min_quality = min_quality
+        self.quality = max_quality
+        self.scale_index = 0
+        self.frame_budget = 1.0 / target_fps
+        self.adaptive = adaptive
+        self.frames_encoded = 0
+        self.frames_reused = 0
+        self._fast_sends = 0
+        self._last_part = None
+        self._last_settings = None
+        self._last_annotations = None
+        self._thumb = None
+        self._last_thumb = None
+        self._diff = None
+        self._scaled = None
+
+    def _is_unchanged(self, frame):
+        """Compare a tiny thumbnail of the frame with the previous one, per channel."""
+        thumb_shape = (24, 32) + frame.shape[2:]
+        if self._thumb is None or self._thumb.shape != thumb_shape:
+            self._thumb = np.empty(thumb_shape, dtype=np.uint8)
+            self._last_thumb = np.empty(thumb_shape, dtype=np.uint8)
+            self._diff = np.empty(thumb_shape, dtype=np.uint8)
+            cv2.resize(frame, (32, 24), dst=self._thumb, interpolation=cv2.INTER_AREA)
+            return False
+
+        cv2.resize(frame, (32, 24), dst=self._thumb, interpolation=cv2.INTER_AREA)
+        cv2.absdiff(self._thumb, self._last_thumb, dst=self._diff)
+        # Worst channel, so a change in one colour (e.g. green annotations) still counts
+        channels = self._diff.shape[2] if self._diff.ndim == 3 else 1
+        return max(cv2.mean(self._diff)[:channels]) < CHANGE_THRESHOLD
+
+    def _scaled_frame(self, frame):
+        """Return the frame at the current output scale, resized into a reused buffer."""
+        scale = SCALES[self.scale_index]
+        if scale == 1.0:
+            return frame
+        height, width = frame.shape[:2]
+        shape = (int(height * scale), int(width * scale)) + frame.shape[2:]
+        if self._scaled is None or self._scaled.shape != shape:
+            self._scaled = np.empty(shape, dtype=frame.dtype)
+        cv2.resize(frame, (shape[1], shape[0]), dst=self._scaled, interpolation=cv2.INTER_AREA)
+        return self._scaled
+
+    def encode(self, frame, annotations=None):
+        """
+        Encode a frame as a multipart MJPEG part.
+
+        Args:
+            frame (np.ndarray): BGR frame, with any annotations already drawn
+            annotations (Hashable): What was drawn on the frame, e.g.
+                (emotion, face_box); the last part is only reused when this
+                matches too, since a label change is too small for the
+                thumbnail diff to see
+
+        Returns:
+            bytes or None: The multipart part, or None if encoding failed
+        """
+        settings = (self.quality, self.scale_index)
+        unchanged = self._is_unchanged(frame)
+        if (self._last_part is not None and unchanged and settings == self._last_settings
+                and annotations == self._last_annotations):
+            self.frames_reused += 1
+            return self._last_part
+
+        ret, buffer = cv2.imencode('.jpg', self._scaled_frame(frame),
+                                   [cv2.IMWRITE_JPEG_QUALITY, self.quality])
+        if not ret:
+            return None
+
+        # join() copies the encoded buffer once, straight from the numpy array
+        part = b''.join((_part_header(buffer.size), buffer, _PART_TAIL))
+
+        # The current thumbnail now describes the last encoded part; swap, don't copy
+        self._thumb, self._last_thumb = self._last_thumb, self._thumb
+        self._last_part = part
+        self._last_settings = settings
+        self._last_annotations = annotations
+        self.frames_encoded += 1
+        return part
+
+    def report_send_time(self, seconds):
+        """
+        Adapt quality and resolution to how long the client took to take a part.
+
+        Slow sends step quality down, then resolution; a run of fast sends steps
+        back up one notch at a time.
+        """
+        if not self.adaptive:
+            return
+
+        if seconds > self.frame_budget:
+            self._fast_sends = 0
+            if self.quality - QUALITY_STEP >= self.min_quality:
+                self.quality -= QUALITY_STEP
+            elif self.scale_index < len(SCALES) - 1:
+                self.scale_index += 1
+        elif seconds < self.frame_budget / 2:
+            self._fast_sends += 1
+            if self._fast_sends >= UPGRADE_AFTER_FRAMES:
+                self._fast_sends = 0
+                if self.scale_index > 0:
+                    self.scale_index -= 1
+                elif self.quality + QUALITY_STEP <= self.max_quality:
+                    self.quality += QUALITY_STEP
+
+    def stream(self, frames):
+        """
+        Wrap an iterator of (frame, annotations) pairs into MJPEG parts, timing each send.
+
+        The time between yielding a part and being resumed is how long the
+        server took to hand it to the client. Reused (unchanged) parts are not
+        sent again; the browser keeps showing the last image.
+        """
+        last_sent = None
+        for frame, annotations in frames:
+            part = self.encode(frame, annotations)
+            if part is None or part is last_sent:
+                continue
+            sent = time.perf_counter()
+            yield part
+            self.report_send_time(time.perf_counter() - sent)
+            last_sent = part
@@ -5,6 +5,10 @@ Model Architecture: Convolutional Neural Network with dropout regularization
 Supported Emotions: Angry, Disgust, Fear, Happy, Sad, Surprise, Neutral (7 classes)
 Input Shape: 48x48 grayscale images
 Output: Emotion class prediction
+
+Variants (see MODEL_VARIANTS): baseline, narrow and compact (depthwise-separable).
+Smaller variants can be distilled from a trained teacher and are recorded in
+the model registry with their accuracy and measured CPU latency.
 """
 
 try:
@@ -12,23 +16,37 @@ try:
     # Assign names from tf.keras to avoid direct "from tensorflow.keras.*" static import issues
     from tensorflow import keras # type: ignore
     Sequential = keras.models.Sequential
+    load_model = keras.models.load_model
     Conv2D = keras.layers.Conv2D
     MaxPooling2D = keras.layers.MaxPooling2D
     Flatten = keras.layers.Flatten
     Dense = keras.layers.Dense
     Dropout = keras.layers.Dropout
+    SeparableConv2D = keras.layers.SeparableConv2D
+    GlobalAveragePooling2D = keras.layers.GlobalAveragePooling2D
+    Rescaling = keras.layers.Rescaling
+    Input = keras.Input
+    Model = keras.Model
     ImageDataGenerator = keras.preprocessing.image.ImageDataGenerator
     EarlyStopping = keras.callbacks.EarlyStopping
     ReduceLROnPlateau = keras.callbacks.ReduceLROnPlateau
 except Exception:
     # Fallback to standalone Keras if tensorflow.keras is not available
-    from keras.models import Sequential
-    from keras.layers import Conv2D, MaxPooling2D, Flatten, Dense, Dropout
+    from keras.models import Sequential, load_model
+    from keras.layers import Conv2D, MaxPooling2D, Flatten, Dense, Dropout, Rescaling
+    from keras.layers import SeparableConv2D, GlobalAveragePooling2D
+    from keras import Input, Model
     from keras.preprocessing.image import ImageDataGenerator # type: ignore
     from keras.callbacks import EarlyStopping, ReduceLROnPlateau
 
+import argparse
 import os
 import sys
+import time
+
+import numpy as np
+
+from model_registry import register_variant
 
 # Configuration
 DATA_DIR = "datasets/train"  # Path to your training images
@@ -36,6 +54,8 @@ IMG_SIZE = 48
 BATCH_SIZE = 32
 EPOCHS = 25
 MODEL_OUTPUT_PATH = "face_emotions_model.h5"
+DISTILL_TEMPERATURE = 4.0
+DISTILL_ALPHA = 0.3  # weight of the hard labels vs. the teacher's soft targets
 
 # Emotion labels
 EMOTION_LABELS = ['Angry', 'Disgust', 'Fear', 'Happy', 'Sad', 'Surprise', 'Neutral']
@@ -45,6 +65,9 @@ def build_model(img_size=IMG_SIZE, num_classes=NUM_EMOTIONS):
     """
     Build CNN model for emotion detection.
     
+    The model takes raw 0-255 pixels: the /255 rescale is its first layer, so
+    serving code can feed uint8 face crops without a float conversion.
+    
     Args:
         img_size (int): Input image size (default: 48)
         num_classes (int): Number of emotion classes (default: 7)
@@ -53,7 +76,8 @@ def build_model(img_size=IMG_SIZE, num_classes=NUM_EMOTIONS):
         Sequential: Compiled Keras model
     """
     model = Sequential([
-        Conv2D(32, (3, 3), activation='relu', input_shape=(img_size, img_size, 1)),
+        Rescaling(1./255, input_shape=(img_size, img_size, 1)),
+        Conv2D(32, (3, 3), activation='relu'),
         MaxPooling2D((2, 2)),
         Conv2D(64, (3, 3), activation='relu'),
         MaxPooling2D((2, 2)),
@@ -75,6 +99,94 @@ def build_model(img_size=IMG_SIZE, num_classes=NUM_EMOTIONS):
     
     return model
 
+def build_narrow_model(img_size=IMG_SIZE, num_classes=NUM_EMOTIONS):
+    """
+    Build a half-width version of the baseline CNN.
+    
+    Returns:
+        Sequential: Compiled Keras model
+    """
+    model = Sequential([
+        Rescaling(1./255, input_shape=(img_size, img_size, 1)),
+        Conv2D(16, (3, 3), activation='relu'),
+        MaxPooling2D((2, 2)),
+        Conv2D(32, (3, 3), activation='relu'),
+        MaxPooling2D((2, 2)),
+        Conv2D(64, (3, 3), activation='relu'),
+        MaxPooling2D((2, 2)),
+        Flatten(),
+        Dense(128, activation='relu'),
+        Dropout(0.5),
+        Dense(num_classes, activation='softmax')
+    ])
+    
+    model.compile(
+        optimizer='adam',
+        loss='categorical_crossentropy',
+        metrics=['accuracy']
+    )
+    
+    return model
+
+def build_compact_model(img_size=IMG_SIZE, num_classes=NUM_EMOTIONS):
+    """
+    Build a compact CNN from depthwise-separable convolutions.
+    
+    Global average pooling replaces the large Flatten/Dense head, which holds
+    most of the baseline's parameters.
+    
+    Returns:
+        Sequential: Compiled Keras model
+    """
+    model = Sequential([
+        Rescaling(1./255, input_shape=(img_size, img_size, 1)),
+        Conv2D(16, (3, 3), activation='relu', padding='same'),
+        MaxPooling2D((2, 2)),
+        SeparableConv2D(32, (3, 3), activation='relu', padding='same'),
+        MaxPooling2D((2, 2)),
+        SeparableConv2D(64, (3, 3), activation='relu', padding='same'),
+        MaxPooling2D((2, 2)),
+        SeparableConv2D(128, (3, 3), activation='relu', padding='same'),
+        GlobalAveragePooling2D(),
+        Dropout(0.3),
+        Dense(num_classes, activation='softmax')
+    ])
+    
+    model.compile(
+        optimizer='adam',
+        loss='categorical_crossentropy',
+        metrics=['accuracy']
+    )
+    
+    return model
+
+MODEL_VARIANTS = {
+    'baseline': build_model,
+    'narrow': build_narrow_model,
+    'compact': build_compact_model
+}
+
+def fold_rescaling(model, img_size=IMG_SIZE):
+    """
+    Ensure a model accepts raw 0-255 pixels by folding the /255 rescale into it.
+    
+    Models built by build_model() already start with a Rescaling layer and are
+    returned unchanged; older models trained on [0, 1] inputs are wrapped.
+    
+    Args:
+        model: Loaded Keras model
+        img_size (int): Input image size
+    
+    Returns:
+        Model: A model whose input is unnormalized pixels
+    """
+    if any(isinstance(layer, Rescaling) for layer in model.layers[:1]):
+        return model
+    
+    inputs = Input(shape=(img_size, img_size, 1))
+    outputs = model(Rescaling(1./255)(inputs))
+    return Model(inputs, outputs, name=f'{model.name}_uint8')
+
 def prepare_data(data_dir, img_size=IMG_SIZE, batch_size=BATCH_SIZE):
     """
     Prepare training and validation data generators.
@@ -87,8 +199,8 @@ def prepare_data(data_dir, img_size=IMG_SIZE, batch_size=BATCH_SIZE):
     Returns:
         tuple: (train_generator, val_generator)
     """
+    # No rescale here: build_model() rescales inside the graph
     datagen = ImageDataGenerator(
-        rescale=1./255,
         rotation_range=20,
         horizontal_flip=True,
         width_shift_range=0.1,
@@ -146,8 +258,103 @@ def train_model(model, train_gen, val_gen, epochs=EPOCHS):
     
     return history
 
+def distillation_batches(teacher, data_gen, temperature=DISTILL_TEMPERATURE, alpha=DISTILL_ALPHA):
+    """
+    Yield (images, targets) where targets blend hard labels with the teacher's
+    temperature-softened predictions.
+    
+    Args:
+        teacher: Trained model taking raw 0-255 pixels
+        data_gen: Generator of (images, one_hot_labels) batches
+        temperature (float): Softening temperature for the teacher outputs
+        alpha (float): Weight of the hard labels
+    """
+    while True:
+        images, labels = next(data_gen)
+        probs = teacher.predict(images, verbose=0)
+        softened = np.power(np.clip(probs, 1e-8, 1.0), 1.0 / temperature)
+        softened /= softened.sum(axis=1, keepdims=True)
+        yield images, alpha * labels + (1.0 - alpha) * softened
+
+def distill_model(teacher, student, train_gen, val_gen, epochs=EPOCHS,
+                  temperature=DISTILL_TEMPERATURE, alpha=DISTILL_ALPHA):
+    """
+    Train a smaller student model to mimic a trained teacher.
+    
+    Args:
+        teacher: Trained teacher model
+        student: Compiled student model
+        train_gen: Training data generator
+        val_gen: Validation data generator (hard labels)
+        epochs (int): Number of training epochs
+    
+    Returns:
+        History: Training history object
+    """
+    callbacks = [
+        EarlyStopping(monitor='val_loss', patience=5, restore_best_weights=True),
+        ReduceLROnPlateau(monitor='val_loss', factor=0.5, patience=3, min_lr=1e-7)
+    ]
+    
+    return student.fit(
+        distillation_batches(teacher, train_gen, temperature, alpha),
+        steps_per_epoch=len(train_gen),
+        validation_data=val_gen,
+        epochs=epochs,
+        callbacks=callbacks,
+        verbose=1
+    )
+
+def measure_latency(model, runs=50, img_size=IMG_SIZE):
+    """
+    Measure median single-face CPU inference latency in milliseconds.
+    
+    Times model.predict() on one uint8 face, the call serving makes per request,
+    so the figure includes predict()'s per-call overhead and is comparable with
+    the latencies face_emotions.record_inference_latency checks at serving time.
+    """
+    face = np.random.randint(0, 256, size=(1, img_size, img_size, 1), dtype=np.uint8)
+    for _ in range(5):
+        model.predict(face, verbose=0)
+    
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        model.predict(face, verbose=0)
+        timings.append((time.perf_counter() - start) * 1000)
+    return float(np.median(timings))
+
+def evaluate_and_register(model, name, path, val_gen, distilled_from=None):
+    """Evaluate validation accuracy, measure latency and record the variant."""
+    _, accuracy = model.evaluate(val_gen, verbose=0)
+    latency_ms = measure_latency(model)
+    entry = register_variant(
+        name, path, accuracy, latency_ms,
+        parameters=int(model.count_params()),
+        distilled_from=distilled_from
+    )
+    print(f"Registered '{name}': accuracy={entry['accuracy']:.4f}, latency={entry['latency_ms']:.2f}ms")
+    return entry
+
+def parse_args():
+    """Parse command-line options."""
+    parser = argparse.ArgumentParser(description='Train an emotion detection model variant')
+    parser.add_argument('--variant', choices=sorted(MODEL_VARIANTS), default='baseline',
+                        help='Architecture to train (default: baseline)')
+    parser.add_argument('--distill-from', metavar='TEACHER_PATH',
+                        help='Distill from this trained model instead of training on labels alone')
+    parser.add_argument('--output', help='Output model path (default depends on variant)')
+    parser.add_argument('--epochs', type=int, default=EPOCHS)
+    parser.add_argument('--register-only', metavar='MODEL_PATH',
+                        help='Only evaluate/benchmark an existing model and add it to the registry')
+    return parser.parse_args()
+
 def main():
     """Main function to orchestrate model training."""
+    args = parse_args()
+    output_path = args.output or (MODEL_OUTPUT_PATH if args.variant == 'baseline'
+                                  else f"face_emotions_{args.variant}.h5")
+    
     try:
         # Check if data directory exists
         if not os.path.exists(DATA_DIR):
@@ -162,12 +369,19 @@ def main():
         print(f"Emotion Classes: {', '.join(EMOTION_LABELS)}")
         print(f"Image Size: {IMG_SIZE}x{IMG_SIZE}")
         print(f"Batch Size: {BATCH_SIZE}")
-        print(f"Epochs: {EPOCHS}")
+        print(f"Epochs: {args.epochs}")
+        print(f"Variant: {args.variant}")
         print("=" * 60)
         
+        if args.register_only:
+            _, val_gen = prepare_data(DATA_DIR, IMG_SIZE, BATCH_SIZE)
+            existing = fold_rescaling(load_model(args.register_only))
+            evaluate_and_register(existing, args.variant, args.register_only, val_gen)
+            return
+        
         # Build model
         print("\n[1/3] Building model architecture...")
-        model = build_model(IMG_SIZE, NUM_EMOTIONS)
+        model = MODEL_VARIANTS[args.variant](IMG_SIZE, NUM_EMOTIONS)
         print(f"Model built successfully!")
         print(model.summary())
         
@@ -178,14 +392,22 @@ def main():
         print(f"Validation samples: {val_gen.samples}")
         
         # Train model
-        print("\n[3/3] Training model...")
-        history = train_model(model, train_gen, val_gen, EPOCHS)
+        if args.distill_from:
+            print(f"\n[3/3] Distilling from '{args.distill_from}'...")
+            teacher = fold_rescaling(load_model(args.distill_from))
+            history = distill_model(teacher, model, train_gen, val_gen, args.epochs)
+        else:
+            print("\n[3/3] Training model...")
+            history = train_model(model, train_gen, val_gen, args.epochs)
         
         # Save model
-        print(f"\nSaving model to '{MODEL_OUTPUT_PATH}'...")
-        model.save(MODEL_OUTPUT_PATH)
+        print(f"\nSaving model to '{output_path}'...")
+        model.save(output_path)
         print(f"✓ Model training completed and saved successfully!")
         
+        teacher_name = os.path.splitext(os.path.basename(args.distill_from))[0] if args.distill_from else None
+        evaluate_and_register(model, args.variant, output_path, val_gen, distilled_from=teacher_name)
+        
         # Print final metrics
         print("\n" + "=" * 60)
         print("Training Summary:")
@@ -0,0 +1,96 @@
+"""
+Model Registry Module
+Records each trained model variant with its validation accuracy and measured
+CPU latency, and picks the variant that fits a per-frame latency budget.
+
+The registry is a small JSON file next to the models:
+    {"variants": [{"name": "compact", "path": "face_emotions_compact.h5",
+                   "accuracy": 0.61, "latency_ms": 1.4, ...}, ...]}
+"""
+
+import json
+import os
+import threading
+from datetime import datetime
+
+REGISTRY_PATH = os.environ.get('MODEL_REGISTRY_PATH', 'model_registry.json')
+
+_lock = threading.Lock()
+
+def load_registry(path=REGISTRY_PATH):
+    """
+    Load the registry.
+
+    Returns:
+        list: Variant entries (empty if the registry doesn't exist or is invalid)
+    """
+    try:
+        with open(path) as f:
+            return json.load(f).get('variants', [])
+    except FileNotFoundError:
+        return []
+    except (ValueError, OSError) as e:
+        print(f"Error reading model registry {path}: {e}")
+        return []
+
+def register_variant(name, path, accuracy, latency_ms, parameters=None, distilled_from=None,
+                     registry_path=REGISTRY_PATH):
+    """
+    Add or replace a variant entry.
+
+    Args:
+        name (str): Variant name (e.g. 'baseline', 'narrow', 'compact')
+        path (str): Saved model path
+        accuracy (float): Validation accuracy (0-1)
+        latency_ms (float): Measured single-face CPU latency in milliseconds
+        parameters (int): Parameter count
+        distilled_from (str): Teacher variant name, if distilled
+
+    Returns:
+        dict: The stored entry
+    """
+    entry = {
+        'name': name,
+        'path': path,
+        'accuracy': round(float(accuracy), 4),
+        'latency_ms': round(float(latency_ms), 3),
+        'parameters': parameters,
+        'distilled_from': distilled_from,
+        'registered_at': datetime.now().isoformat()
+    }
+    with _lock:
+        variants = [v for v in load_registry(registry_path) if v['name'] != name]
+        variants.append(entry)
+        variants.sort(key=lambda v: v['latency_ms'])
+        with open(registry_path, 'w') as f:
+            json.dump({'variants': variants}, f, indent=2)
+    return entry
+
+def select_variant(budget_ms, variants=None):
+    """
+    Pick the most accurate variant whose measured latency fits the budget.
+
+    Falls back to the fastest variant if none fit.
+
+    Returns:
+        dict or None: Selected entry (None if the registry is empty)
+    """
+    variants = load_registry() if variants is None else variants
+    available = [v for v in variants if os.path.exists(v['path'])]
+    if not available:
+        return None
+
+    fitting = [v for v in available if v['latency_ms'] <= budget_ms]
+    if fitting:
+        return max(fitting, key=lambda v: v['accuracy'])
+    return min(available, key=lambda v: v['latency_ms'])
+
+def next_cheaper(name, variants=None):
+    """Return the next faster variant than `name` (None if it's already the fastest)."""
+    variants = load_registry() if variants is None else variants
+    current = next((v for v in variants if v['name'] == name), None)
+    if current is None:
+        return None
+    cheaper = [v for v in variants
+               if v['latency_ms'] < current['latency_ms'] and os.path.exists(v['path'])]
+    return max(cheaper, key=lambda v: v['latency_ms']) if cheaper else None
@@ -0,0 +1,349 @@
+"""
+Model Server Module
+Runs the emotion model in a single process that gunicorn workers reach over a
+local Unix socket, so TensorFlow and the model weights are resident once per
+box instead of once per worker.
+
+The server runs under a small supervisor process that restarts it if it dies
+(e.g. TensorFlow running out of memory); streams hosted in it are lost on a
+restart and have to be added again.
+"""
+
+import os
+import queue
+import secrets
+import signal
+import threading
+import time
+from multiprocessing import get_context
+from multiprocessing.connection import Listener, Client
+
+import numpy as np
+
+# Configuration
+MODEL_SERVER_ADDRESS = os.environ.get('MODEL_SERVER_ADDRESS', '/tmp/emotion_model_server.sock')
+MAX_BATCH_SIZE = int(os.environ.get('MODEL_SERVER_MAX_BATCH', 64))
+BATCH_WAIT_SECONDS = float(os.environ.get('MODEL_SERVER_BATCH_WAIT_MS', 2)) / 1000.0
+STARTUP_TIMEOUT = 120.0
+# A reply slower than this fails the request instead of holding its thread forever
+REQUEST_TIMEOUT = float(os.environ.get('MODEL_SERVER_TIMEOUT_SECONDS', 30))
+SUPERVISE_INTERVAL = 1.0
+RESTART_DELAY = 2.0
+
+def get_authkey():
+    """Return the shared authkey, generating one for this process tree if unset."""
+    key = os.environ.get('MODEL_SERVER_AUTHKEY')
+    if not key:
+        key = secrets.token_hex(16)
+        os.environ['MODEL_SERVER_AUTHKEY'] = key
+    return key.encode()
+
+class _PendingRequest:
+    """A batch of faces waiting for inference, with a slot for the result."""
+
+    def __init__(self, faces):
+        self.faces = faces
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+def _inference_loop(request_queue):
+    """
+    Drain queued requests into combined batches and run them through the model.
+
+    Concurrent requests from different workers are coalesced into a single
+    predict call of up to MAX_BATCH_SIZE faces.
+    """
+    from face_emotions import to_model_input, get_model, record_inference_latency
+
+    while True:
+        pending = [request_queue.get()]
+        total = len(pending[0].faces)
+        deadline = time.monotonic() + BATCH_WAIT_SECONDS
+        while total < MAX_BATCH_SIZE:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = request_queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            pending.append(item)
+            total += len(item.faces)
+
+        try:
+            batch = np.concatenate([to_model_input(p.faces) for p in pending], axis=0)
+            # Looked up per batch so latency-budget variant switches take effect
+            start = time.perf_counter()
+            predictions = get_model().predict(batch, verbose=0)
+            # Each request is charged its share of the coalesced call, not the whole batch
+            batch_ms = (time.perf_counter() - start) * 1000
+            for p in pending:
+                record_inference_latency(batch_ms * len(p.faces) / total, len(p.faces))
+            offset = 0
+            for p in pending:
+                p.result = predictions[offset:offset + len(p.faces)]
+                offset += len(p.faces)
+        except Exception as e:
+            print(f"Model server inference error: {e}")
+            for p in pending:
+                p.error = str(e)
+        finally:
+            for p in pending:
+                p.done.set()
+
+def _queued_predict(request_queue):
+    """Return a predict(faces) for callers inside the server that joins the batching queue."""
+    def predict(faces):
+        pending = _PendingRequest(faces)
+        request_queue.put(pending)
+        pending.done.wait()
+        if pending.error is not None:
+            raise RuntimeError(pending.error)
+        return pending.result
+    return predict
+
+def _handle_stream_command(command, args):
+    """
+    Run a /api/streams command against the StreamManager hosted in this process.
+
+    Workers proxy here so every worker sees the same set of streams.
+    """
+    from stream_manager import get_stream_manager
+    from emotion_events import emotion_events
+
+    manager = get_stream_manager()
+    if command == 'add':
+        return manager.add_source(*args).snapshot()
+    if command == 'remove':
+        return manager.remove_source(*args)
+    if command == 'stats':
+        return manager.stats()
+    if command == 'events':
+        return emotion_events.updates_since(*args)
+    raise ValueError(f"Unknown stream command '{command}'")
+
+def _handle_connection(conn, request_queue):
+    """Serve predict and stream requests from one worker connection until it closes."""
+    try:
+        while True:
+            try:
+                faces = conn.recv()
+            except EOFError:
+                break
+
+            if isinstance(faces, str) and faces == 'ping':
+                conn.send('pong')
+                continue
+
+            if isinstance(faces, tuple) and faces[0] == 'streams':
+                try:
+                    conn.send(_handle_stream_command(faces[1], faces[2:]))
+                except Exception as e:
+                    conn.send(e)
+                continue
+
+            pending = _PendingRequest(faces)
+            request_queue.put(pending)
+            pending.done.wait()
+            if pending.error is not None:
+                conn.send(RuntimeError(pending.error))
+            else:
+                conn.send(pending.result)
+    except Exception as e:
+        print(f"Model server connection error: {e}")
+    finally:
+        conn.close()
+
+def serve(address=MODEL_SERVER_ADDRESS, authkey=None):
+    """
+    Load the model and serve inference requests on a Unix socket (blocking).
+
+    Args:
+        address (str): Unix socket path to listen on
+        authkey (bytes): Shared secret required from clients
+    """
+    # The server batches for every worker on its own share of the CPU budget
+    # (MODEL_SERVER_CPU_BUDGET, default half); workers split the rest
+    from execution_config import apply_execution_config, ROLE_MODEL_SERVER
+    apply_execution_config(os.environ.get('EXECUTION_PROFILE'), ROLE_MODEL_SERVER)
+
+    # The address is inherited from the gunicorn master's environment; unset it
+    # so face_emotions runs the model locally here instead of calling itself
+    os.environ.pop('MODEL_SERVER_ADDRESS', None)
+
+    # Imported here so the server process, not the caller, owns TensorFlow
+    import face_emotions
+
+    if not face_emotions.warm_up():
+        raise RuntimeError(f"Model server failed to load model: {face_emotions.get_readiness()['error']}")
+
+    if os.path.exists(address):
+        os.remove(address)
+
+    request_queue = queue.Queue()
+    threading.Thread(
+        target=_inference_loop,
+        args=(request_queue,),
+        name='model-server-inference',
+        daemon=True
+    ).start()
+
+    # Stream batches share the inference thread with worker requests rather
+    # than calling the model from a second thread
+    from stream_manager import StreamManager, InferenceScheduler, set_stream_manager
+    set_stream_manager(StreamManager(InferenceScheduler(predict=_queued_predict(request_queue))))
+
+    with Listener(address, family='AF_UNIX', authkey=authkey or get_authkey()) as listener:
+        print(f"Model server listening on {address}")
+        while True:
+            try:
+                conn = listener.accept()
+            except Exception as e:
+                print(f"Model server accept error: {e}")
+                continue
+            threading.Thread(target=_handle_connection, args=(conn, request_queue), daemon=True).start()
+
+def _supervise(address, authkey, parent_pid):
+    """
+    Supervisor process entry point: keep a model server running until SIGTERM.
+
+    Restarts the server RESTART_DELAY seconds after it exits, and stops it if
+    the process that started the supervisor goes away.
+    """
+    stopping = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.set())
+
+    process = None
+    while not stopping.is_set() and os.getppid() == parent_pid:
+        if process is None or not process.is_alive():
+            if process is not None:
+                print(f"Model server exited with code {process.exitcode}; restarting")
+                if stopping.wait(RESTART_DELAY):
+                    break
+            process = get_context('spawn').Process(
+                target=serve, args=(address, authkey), name='emotion-model-server', daemon=True
+            )
+            process.start()
+        stopping.wait(SUPERVISE_INTERVAL)
+
+    if process is not None and process.is_alive():
+        process.terminate()
+        process.join(timeout=10)
+
+def start_model_server_process(address=MODEL_SERVER_ADDRESS):
+    """
+    Start the supervised model server in a fresh (spawned) process and wait until it answers.
+
+    Args:
+        address (str): Unix socket path for the server
+
+    Returns:
+        Process: The supervisor process (terminate it to stop the server)
+    """
+    authkey = get_authkey()
+    # 'spawn' so the child starts clean rather than inheriting a forked parent;
+    # not a daemon, since daemonic processes may not start the server child
+    process = get_context('spawn').Process(
+        target=_supervise, args=(address, authkey, os.getpid()), name='emotion-model-supervisor'
+    )
+    process.start()
+
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    while time.monotonic() < deadline:
+        if not process.is_alive():
+            raise RuntimeError('Model server process exited during startup')
+        try:
+            conn = Client(address, family='AF_UNIX', authkey=authkey)
+            conn.send('ping')
+            conn.recv()
+            conn.close()
+            return process
+        except (FileNotFoundError, ConnectionRefusedError):
+            time.sleep(0.2)
+
+    process.terminate()
+    raise RuntimeError(f'Model server did not start within {STARTUP_TIMEOUT}s')
+
+class ModelServerClient:
+    """Per-thread connection to the model server with a predict() like Keras."""
+
+    def __init__(self, address=MODEL_SERVER_ADDRESS, timeout=REQUEST_TIMEOUT):
+        self.address = address
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = Client(self.address, family='AF_UNIX', authkey=get_authkey())
+            self._local.conn = conn
+        return conn
+
+    def _reset(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            try:
+                conn.close()
+            except Exception:
+                pass
+        self._local.conn = None
+
+    def _request(self, message):
+        """
+        Send one message and return the reply, raising errors sent back by the server.
+
+        Raises:
+            TimeoutError: If the server doesn't reply within self.timeout seconds
+        """
+        for attempt in range(2):
+            try:
+                conn = self._connection()
+                conn.send(message)
+                replied = conn.poll(self.timeout)
+                if replied:
+                    result = conn.recv()
+                break
+            except (EOFError, OSError):
+                # Server restarted or connection dropped; reconnect once
+                self._reset()
+                if attempt == 1:
+                    raise
+        if not replied:
+            # Drop the connection so a late reply isn't read as the next answer
+            self._reset()
+            raise TimeoutError(f'Model server did not reply within {self.timeout}s')
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def predict(self, faces):
+        """
+        Run a batch of preprocessed faces through the remote model.
+
+        Args:
+            faces (np.ndarray): Batch shaped (N, FACE_SIZE, FACE_SIZE, 1)
+
+        Returns:
+            np.ndarray: Predictions shaped (N, num_emotions)
+        """
+        return self._request(faces)
+
+    def stream_command(self, command, *args):
+        """Run a StreamManager command ('add', 'remove', 'stats', 'events') in the server."""
+        return self._request(('streams', command) + args)
+
+    def ping(self):
+        """Return True if the model server answers."""
+        try:
+            conn = self._connection()
+            conn.send('ping')
+            if not conn.poll(self.timeout):
+                raise TimeoutError('Model server did not answer ping')
+            return conn.recv() == 'pong'
+        except Exception:
+            self._reset()
+            return False
+
+if __name__ == '__main__':
+    serve()
@@ -0,0 +1,86 @@
+"""
+Preprocessing Module
+Per-thread reusable buffers for the detection/inference hot path, so
+grayscale conversion, histogram equalization and face crops are written into
+preallocated arrays instead of allocating new ones for every frame and face.
+
+Face batches stay uint8: the /255 rescale lives inside the model graph
+(see model.fold_rescaling), so crops go to the model without a float copy.
+"""
+
+import threading
+
+import cv2
+import numpy as np
+
+FACE_SIZE = 48
+INITIAL_BATCH_CAPACITY = 8
+
+class BufferArena:
+    """
+    Reusable buffers owned by a single thread.
+
+    Arrays returned by this class are views into the arena and are overwritten
+    by the next call of the same kind on the same thread; copy them if they
+    must outlive the current frame.
+    """
+
+    def __init__(self, face_size=FACE_SIZE):
+        self.face_size = face_size
+        self._gray = None
+        self._equalized = None
+        self._faces = np.empty((INITIAL_BATCH_CAPACITY, face_size, face_size), dtype=np.uint8)
+
+    def _frame_buffer(self, current, shape):
+        if current is None or current.shape != shape:
+            return np.empty(shape, dtype=np.uint8)
+        return current
+
+    def to_gray(self, frame):
+        """Convert a BGR frame to grayscale into the arena's gray buffer."""
+        if frame.ndim == 2:
+            return frame
+        self._gray = self._frame_buffer(self._gray, frame.shape[:2])
+        cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=self._gray)
+        return self._gray
+
+    def equalize(self, gray):
+        """Histogram-equalize a grayscale image into the arena's buffer."""
+        self._equalized = self._frame_buffer(self._equalized, gray.shape)
+        cv2.equalizeHist(gray, dst=self._equalized)
+        return self._equalized
+
+    def face_batch(self, gray, faces):
+        """
+        Crop and resize faces straight into the arena's batch buffer.
+
+        Args:
+            gray (np.ndarray): Grayscale image
+            faces (Sequence): Face coordinates (x, y, w, h)
+
+        Returns:
+            np.ndarray: uint8 view shaped (len(faces), FACE_SIZE, FACE_SIZE, 1),
+                or None if any crop is empty
+        """
+        count = len(faces)
+        if count > len(self._faces):
+            self._faces = np.empty((max(count, 2 * len(self._faces)), self.face_size, self.face_size), dtype=np.uint8)
+
+        size = (self.face_size, self.face_size)
+        for index, (x, y, w, h) in enumerate(faces):
+            roi = gray[y:y+h, x:x+w]
+            if roi.size == 0:
+                return None
+            cv2.resize(roi, size, dst=self._faces[index])
+
+        return self._faces[:count, :, :, np.newaxis]
+
+_local = threading.local()
+
+def get_arena():
+    """Return the calling thread's BufferArena, creating it on first use."""
+    arena = getattr(_local, 'arena', None)
+    if arena is None:
+        arena = BufferArena()
+        _local.arena = arena
+    return arena
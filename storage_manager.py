@@ -0,0 +1,447 @@
+"""
+Storage Manager
+Background lifecycle for uploaded and captured images.
+
+Each pass runs five jobs over the detection records:
+    thumbnails: store a small JPEG face-crop thumbnail for every record
+        (optionally replacing the original when STORAGE_KEEP_ORIGINALS=False)
+    archive: move originals older than STORAGE_ARCHIVE_AFTER_DAYS into one
+        zip per month, downscaled and re-encoded as smaller JPEGs, so uploads/
+        stops accumulating loose full-size files
+    retention: delete records older than STORAGE_RETENTION_DAYS together with
+        their files, in batches
+    partition: move closed months from SQLite into the compressed columnar
+        archive tier (database.archive_closed_months)
+    compact: incremental VACUUM of the SQLite file
+
+Archived images are referenced as 'uploads/archive/2024-01.zip!/<filename>';
+use read_image_bytes() to read any stored image path.
+
+Usage:
+    python storage_manager.py --once
+    python storage_manager.py --once --dry-run
+    python storage_manager.py --interval 3600
+"""
+
+import argparse
+import os
+import sys
+import threading
+import time
+import zipfile
+from multiprocessing import get_context
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta, timezone
+
+import cv2
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows: passes are not serialised across processes
+    fcntl = None
+
+from database import (get_detections_without_thumbnail, get_detections_before, update_storage_paths,
+                      delete_detections_bulk, count_image_path_prefix, compact_database,
+                      archive_closed_months, delete_archived_months)
+
+# Configuration
+UPLOAD_FOLDER = os.environ.get('UPLOAD_FOLDER', 'uploads')  # same override as app.py
+THUMBNAIL_FOLDER = os.path.join(UPLOAD_FOLDER, 'thumbnails')
+ARCHIVE_FOLDER = os.path.join(UPLOAD_FOLDER, 'archive')
+ARCHIVE_SEPARATOR = '!/'
+LOCK_PATH = os.path.join(UPLOAD_FOLDER, '.storage_manager.lock')
+
+THUMBNAIL_SIZE = int(os.environ.get('STORAGE_THUMBNAIL_SIZE', 96))
+THUMBNAIL_QUALITY = int(os.environ.get('STORAGE_THUMBNAIL_QUALITY', 70))
+KEEP_ORIGINALS = os.environ.get('STORAGE_KEEP_ORIGINALS', 'True') == 'True'
+ARCHIVE_AFTER_DAYS = int(os.environ.get('STORAGE_ARCHIVE_AFTER_DAYS', 30))  # 0 = never archive
+# Archived originals are re-encoded: JPEG data gains almost nothing from deflate
+ARCHIVE_MAX_DIMENSION = int(os.environ.get('STORAGE_ARCHIVE_MAX_DIMENSION', 1280))
+ARCHIVE_JPEG_QUALITY = int(os.environ.get('STORAGE_ARCHIVE_JPEG_QUALITY', 75))
+RETENTION_DAYS = int(os.environ.get('STORAGE_RETENTION_DAYS', 0))  # 0 = keep forever
+BATCH_SIZE = int(os.environ.get('STORAGE_BATCH_SIZE', 500))
+VACUUM_PAGES = int(os.environ.get('STORAGE_VACUUM_PAGES', 1000))
+MANAGER_INTERVAL = int(os.environ.get('STORAGE_MANAGER_INTERVAL', 0))  # seconds, 0 = not started by the app
+# Pad face crops so thumbnails keep some context around the face
+FACE_PADDING = 0.2
+
+def is_archived(image_path):
+    """Whether an image path refers to a member of a monthly archive."""
+    return ARCHIVE_SEPARATOR in (image_path or '')
+
+def read_image_bytes(image_path):
+    """
+    Read a stored image, whether it is a loose file or an archive member.
+
+    Returns:
+        bytes or None: Encoded image bytes (None if missing)
+    """
+    try:
+        if is_archived(image_path):
+            archive_path, member = image_path.split(ARCHIVE_SEPARATOR, 1)
+            with zipfile.ZipFile(archive_path) as archive:
+                return archive.read(member)
+        with open(image_path, 'rb') as f:
+            return f.read()
+    except (OSError, KeyError, zipfile.BadZipFile) as e:
+        print(f"Error reading stored image {image_path}: {e}")
+        return None
+
+def _remove_file(path):
+    try:
+        os.remove(path)
+        return True
+    except FileNotFoundError:
+        return False
+    except OSError as e:
+        print(f"Error removing {path}: {e}")
+        return False
+
+def _month_of(timestamp):
+    """'YYYY-MM' for a SQLite timestamp string."""
+    return str(timestamp)[:7]
+
+def _utc_cutoff(days):
+    """SQLite CURRENT_TIMESTAMP-formatted UTC cutoff `days` ago."""
+    return (datetime.now(timezone.utc) - timedelta(days=days)).strftime('%Y-%m-%d %H:%M:%S')
+
+def archive_bytes(image_path, max_dimension=ARCHIVE_MAX_DIMENSION, quality=ARCHIVE_JPEG_QUALITY):
+    """
+    Bytes to archive for an original: downscaled to max_dimension and
+    re-encoded as JPEG at `quality`, or the file unchanged if that isn't smaller
+    (or the file can't be decoded).
+
+    Args:
+        image_path (str): Path of the original file
+
+    Returns:
+        bytes: Data to store in the archive
+    """
+    with open(image_path, 'rb') as f:
+        original = f.read()
+
+    image = cv2.imdecode(np.frombuffer(original, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        return original
+
+    height, width = image.shape[:2]
+    scale = max_dimension / max(height, width)
+    if scale < 1:
+        image = cv2.resize(image, (int(width * scale), int(height * scale)), interpolation=cv2.INTER_AREA)
+    success, encoded = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    if not success or encoded.size >= len(original):
+        return original
+    return encoded.tobytes()
+
+def make_thumbnail(image):
+    """
+    Encode a small JPEG thumbnail centred on the largest detected face.
+
+    Falls back to a centre square crop when no face is found.
+
+    Args:
+        image (np.ndarray): BGR image
+
+    Returns:
+        bytes or None: JPEG-encoded thumbnail
+    """
+    from face_emotions import detect_faces  # cascade only; TensorFlow is not loaded
+
+    height, width = image.shape[:2]
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+    faces = detect_faces(gray)
+
+    if len(faces):
+        x, y, w, h = max(faces, key=lambda f: f[2] * f[3])
+        pad = int(max(w, h) * FACE_PADDING)
+        side = max(w, h) + 2 * pad
+        cx, cy = x + w // 2, y + h // 2
+    else:
+        side = min(width, height)
+        cx, cy = width // 2, height // 2
+
+    x0 = max(0, min(cx - side // 2, width - side))
+    y0 = max(0, min(cy - side // 2, height - side))
+    crop = image[y0:y0 + side, x0:x0 + side]
+    if crop.size == 0:
+        return None
+
+    thumbnail = cv2.resize(crop, (THUMBNAIL_SIZE, THUMBNAIL_SIZE), interpolation=cv2.INTER_AREA)
+    success, encoded = cv2.imencode('.jpg', thumbnail, [cv2.IMWRITE_JPEG_QUALITY, THUMBNAIL_QUALITY])
+    return encoded.tobytes() if success else None
+
+class StorageManager:
+    """Runs the storage lifecycle jobs; one pass at a time across processes."""
+
+    def __init__(self, keep_originals=KEEP_ORIGINALS, archive_after_days=ARCHIVE_AFTER_DAYS,
+                 retention_days=RETENTION_DAYS, batch_size=BATCH_SIZE, vacuum_pages=VACUUM_PAGES):
+        self.keep_originals = keep_originals
+        self.archive_after_days = archive_after_days
+        self.retention_days = retention_days
+        self.batch_size = batch_size
+        self.vacuum_pages = vacuum_pages
+        self._stop = threading.Event()
+        self._thread = None
+
+    def create_thumbnails(self, dry_run=False):
+        """Store a face-crop thumbnail for every record that lacks one."""
+        stats = Counter()
+        failed = set()
+        while True:
+            rows = [row for row in get_detections_without_thumbnail(self.batch_size + len(failed))
+                    if row[0] not in failed]
+            if not rows:
+                break
+
+            updates = []
+            originals = []
+            for record_id, image_path, timestamp in rows[:self.batch_size]:
+                data = read_image_bytes(image_path)
+                image = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR) if data else None
+                thumbnail = make_thumbnail(image) if image is not None else None
+                if thumbnail is None:
+                    # Unreadable or missing original: leave it for retention
+                    failed.add(record_id)
+                    stats['thumbnail_failed'] += 1
+                    continue
+
+                # Month subfolders keep each directory small
+                thumbnail_path = os.path.join(THUMBNAIL_FOLDER, _month_of(timestamp), f"{record_id}.jpg")
+                stats['thumbnails'] += 1
+                stats['thumbnail_bytes'] += len(thumbnail)
+                if dry_run:
+                    failed.add(record_id)
+                    continue
+
+                os.makedirs(os.path.dirname(thumbnail_path), exist_ok=True)
+                with open(thumbnail_path, 'wb') as f:
+                    f.write(thumbnail)
+
+                if self.keep_originals or is_archived(image_path):
+                    updates.append((record_id, image_path, thumbnail_path))
+                else:
+                    updates.append((record_id, thumbnail_path, thumbnail_path))
+                    originals.append(image_path)
+
+            if updates and not update_storage_paths(updates):
+                break
+            # Originals go only after the records stop pointing at them
+            stats['originals_removed'] += sum(_remove_file(path) for path in originals)
+        return dict(stats)
+
+    def archive_originals(self, dry_run=False):
+        """
+        Move originals older than archive_after_days into monthly zip archives.
+
+        Members are re-encoded by archive_bytes() and stored without deflate,
+        which would only spend CPU on already-compressed JPEG data.
+        """
+        stats = Counter()
+        if not self.archive_after_days:
+            return dict(stats)
+
+        cutoff = _utc_cutoff(self.archive_after_days)
+        after_id = 0
+        while True:
+            rows = get_detections_before(cutoff, self.batch_size, after_id)
+            if not rows:
+                break
+            after_id = rows[-1][0]
+
+            by_month = defaultdict(list)
+            for record_id, image_path, thumbnail_path, timestamp in rows:
+                if is_archived(image_path) or image_path == thumbnail_path or not os.path.isfile(image_path):
+                    continue
+                by_month[_month_of(timestamp)].append((record_id, image_path, thumbnail_path))
+
+            for month, records in by_month.items():
+                archive_path = os.path.join(ARCHIVE_FOLDER, f"{month}.zip")
+                stats['archived'] += len(records)
+                stats['archived_bytes'] += sum(os.path.getsize(path) for _, path, _ in records)
+                if dry_run:
+                    continue
+
+                os.makedirs(ARCHIVE_FOLDER, exist_ok=True)
+                updates = []
+                with zipfile.ZipFile(archive_path, 'a', compression=zipfile.ZIP_STORED) as archive:
+                    # Members left by an interrupted pass are reused, not duplicated
+                    existing = set(archive.namelist())
+                    for record_id, image_path, thumbnail_path in records:
+                        member = os.path.basename(image_path)
+                        if member not in existing:
+                            data = archive_bytes(image_path)
+                            archive.writestr(member, data)
+                            stats['stored_bytes'] += len(data)
+                            existing.add(member)
+                        updates.append((record_id, f"{archive_path}{ARCHIVE_SEPARATOR}{member}", thumbnail_path))
+
+                if update_storage_paths(updates):
+                    for _, image_path, _ in records:
+                        _remove_file(image_path)
+        return dict(stats)
+
+    def enforce_retention(self, dry_run=False):
+        """Delete records older than retention_days and their files, in batches."""
+        stats = Counter()
+        if not self.retention_days:
+            return dict(stats)
+
+        cutoff = _utc_cutoff(self.retention_days)
+        after_id = 0
+        touched_archives = set()
+        while True:
+            rows = get_detections_before(cutoff, self.batch_size, after_id)
+            if not rows:
+                break
+            after_id = rows[-1][0]
+
+            files = set()
+            for _, image_path, thumbnail_path, _ in rows:
+                if is_archived(image_path):
+                    touched_archives.add(image_path.split(ARCHIVE_SEPARATOR, 1)[0])
+                elif image_path:
+                    files.add(image_path)
+                if thumbnail_path:
+                    files.add(thumbnail_path)
+
+            if dry_run:
+                stats['records_deleted'] += len(rows)
+                continue
+
+            deleted = delete_detections_bulk([row[0] for row in rows])
+            if not deleted:
+                break
+            stats['records_deleted'] += deleted
+            stats['files_deleted'] += sum(_remove_file(path) for path in files)
+
+        # Archived months are dropped whole once they are entirely past the cutoff
+        if not dry_run:
+            files = set()
+            for image_path, thumbnail_path in delete_archived_months(cutoff[:7]):
+                if is_archived(image_path):
+                    touched_archives.add(image_path.split(ARCHIVE_SEPARATOR, 1)[0])
+                elif image_path:
+                    files.add(image_path)
+                if thumbnail_path:
+                    files.add(thumbnail_path)
+            stats['files_deleted'] += sum(_remove_file(path) for path in files)
+
+        # A month's archive goes once no record references it any more
+        for archive_path in touched_archives:
+            if not dry_run and count_image_path_prefix(archive_path + ARCHIVE_SEPARATOR) == 0:
+                stats['archives_deleted'] += _remove_file(archive_path)
+        return dict(stats)
+
+    def run_once(self, dry_run=False):
+        """
+        Run every job once.
+
+        Returns:
+            dict: Per-job report (None if another process holds the pass lock)
+        """
+        os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+        with open(LOCK_PATH, 'w') as lock_file:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    return None
+
+            started = time.perf_counter()
+            report = {
+                'thumbnails': self.create_thumbnails(dry_run),
+                'archive': self.archive_originals(dry_run),
+                'retention': self.enforce_retention(dry_run),
+                'partition': {} if dry_run else archive_closed_months(),
+                'compact': {} if dry_run else compact_database(self.vacuum_pages)
+            }
+            report['elapsed_seconds'] = round(time.perf_counter() - started, 2)
+            return report
+
+    def _run(self, interval):
+        while not self._stop.is_set():
+            try:
+                self.run_once()
+            except Exception as e:
+                print(f"Error in storage manager pass: {e}")
+            self._stop.wait(interval)
+
+    def start(self, interval=MANAGER_INTERVAL):
+        """Run passes every `interval` seconds on a daemon thread."""
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, args=(interval,), daemon=True,
+                                            name='storage-manager')
+            self._thread.start()
+        return self._thread
+
+    def stop(self):
+        """Stop the background thread after the current pass."""
+        self._stop.set()
+
+def _serve(interval):
+    """Storage-manager process entry point: run passes until terminated."""
+    StorageManager().start(interval).join()
+
+def start_storage_manager_process(interval=MANAGER_INTERVAL):
+    """
+    Run passes every `interval` seconds in a fresh (spawned) process.
+
+    For servers that fork workers (gunicorn): a thread started in the master
+    before fork would be left behind in the parent, and could leave locks it
+    held copied into every worker.
+
+    Returns:
+        Process: The running storage-manager process
+    """
+    process = get_context('spawn').Process(
+        target=_serve, args=(interval,), name='storage-manager', daemon=True
+    )
+    process.start()
+    return process
+
+def main():
+    """Command-line entry point."""
+    parser = argparse.ArgumentParser(description='Thumbnail, archive and prune stored uploads')
+    parser.add_argument('--once', action='store_true', help='Run a single pass and exit')
+    parser.add_argument('--interval', type=int, default=MANAGER_INTERVAL or 3600,
+                        help='Seconds between passes when not using --once (default: 3600)')
+    parser.add_argument('--dry-run', action='store_true', help='Report what would change without changing it')
+    parser.add_argument('--archive-after-days', type=int, default=ARCHIVE_AFTER_DAYS,
+                        help='Archive originals older than this (0 = off)')
+    parser.add_argument('--retention-days', type=int, default=RETENTION_DAYS,
+                        help='Delete records older than this (0 = keep forever)')
+    parser.add_argument('--drop-originals', action='store_true',
+                        help='Keep only the thumbnail for each record')
+    args = parser.parse_args()
+
+    manager = StorageManager(
+        keep_originals=KEEP_ORIGINALS and not args.drop_originals,
+        archive_after_days=args.archive_after_days,
+        retention_days=args.retention_days
+    )
+
+    while True:
+        try:
+            report = manager.run_once(dry_run=args.dry_run)
+        except Exception as e:
+            print(f"Error in storage manager pass: {e}")
+            sys.exit(1)
+
+        if report is None:
+            print("Another storage manager pass is running; skipped")
+        else:
+            print("=" * 60)
+            print(f"Storage Pass{' (dry run)' if args.dry_run else ''} - {datetime.now().isoformat()}")
+            print("=" * 60)
+            for job, stats in report.items():
+                print(f"{job.title()}: {stats}")
+            print("=" * 60)
+
+        if args.once:
+            break
+        time.sleep(args.interval)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,487 @@
+"""
+Stream Manager Module
+Watches many video sources at once (camera device indices, RTSP/HTTP URLs and
+video files). Each source gets its own capture thread with a configurable
+sampling rate; face crops from every source feed one shared, batched inference
+scheduler that serves streams round-robin and tracks per-stream latency.
+
+Usage:
+    python stream_manager.py --source cam0=0 --source lobby=rtsp://127.0.0.1:8554/lobby \
+        --source clip=videos/sample.mp4 --sample-fps 5
+"""
+
+import argparse
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+
+import cv2
+import numpy as np
+
+from face_emotions import detect_faces, extract_face, predict_faces, labels_from_predictions
+from emotion_events import emotion_events, HEARTBEAT_SECONDS
+from preprocessing import get_arena
+
+# Configuration
+DEFAULT_SAMPLE_FPS = float(os.environ.get('STREAM_SAMPLE_FPS', 5))
+MAX_BATCH_SIZE = int(os.environ.get('STREAM_MAX_BATCH', 64))
+BATCH_WAIT_SECONDS = float(os.environ.get('STREAM_BATCH_WAIT_MS', 10)) / 1000.0
+MAX_QUEUE_PER_STREAM = int(os.environ.get('STREAM_MAX_QUEUE', 8))
+LATENCY_WINDOW = 500
+RECONNECT_DELAY = 2.0
+
+def parse_source(source):
+    """Return an int for camera device indices, otherwise the URL/path string."""
+    source = str(source).strip()
+    return int(source) if source.isdigit() else source
+
+def _percentile(values, pct):
+    if not values:
+        return None
+    return round(float(np.percentile(values, pct)), 2)
+
+class StreamStats:
+    """Counters and a rolling latency window for one stream."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.frames_read = 0
+        self.frames_sampled = 0
+        self.faces_submitted = 0
+        self.faces_inferred = 0
+        self.faces_dropped = 0
+        self.latencies_ms = deque(maxlen=LATENCY_WINDOW)
+
+    def add(self, **counts):
+        with self._lock:
+            for name, value in counts.items():
+                setattr(self, name, getattr(self, name) + value)
+
+    def record_latency(self, latency_ms):
+        with self._lock:
+            self.faces_inferred += 1
+            self.latencies_ms.append(latency_ms)
+
+    def snapshot(self):
+        with self._lock:
+            latencies = list(self.latencies_ms)
+            return {
+                'frames_read': self.frames_read,
+                'frames_sampled': self.frames_sampled,
+                'faces_submitted': self.faces_submitted,
+                'faces_inferred': self.faces_inferred,
+                'faces_dropped': self.faces_dropped,
+                'latency_ms': {
+                    'p50': _percentile(latencies, 50),
+                    'p95': _percentile(latencies, 95),
+                    'p99': _percentile(latencies, 99)
+                }
+            }
+
+class InferenceScheduler:
+    """
+    Shared batched inference for all streams.
+
+    Each stream has a small bounded queue (oldest crops are dropped when a
+    stream outpaces inference). Batches are filled round-robin across streams,
+    starting from a rotating offset, so a busy stream can't starve the others.
+    """
+
+    def __init__(self, max_batch=MAX_BATCH_SIZE, max_wait=BATCH_WAIT_SECONDS, max_queue=MAX_QUEUE_PER_STREAM,
+                 predict=predict_faces):
+        self.predict = predict
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.max_queue = max_queue
+        self._queues = OrderedDict()
+        self._condition = threading.Condition()
+        self._pending = 0
+        self._rotation = 0
+        self._running = False
+        self._thread = None
+        self.batches = 0
+        self.batch_faces = 0
+
+    def start(self):
+        with self._condition:
+            if self._running:
+                return
+            self._running = True
+        self._thread = threading.Thread(target=self._run, name='inference-scheduler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        with self._condition:
+            self._running = False
+            self._condition.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+
+    def submit(self, stream_id, face, captured_at, callback):
+        """
+        Queue one face crop for inference.
+
+        Args:
+            stream_id (str): Owning stream
+            face (np.ndarray): uint8 crop shaped (FACE_SIZE, FACE_SIZE, 1)
+            captured_at (float): time.perf_counter() when the frame was read
+            callback (callable): called as callback(emotion, confidence, latency_ms)
+
+        Returns:
+            bool: False if an older crop from this stream was dropped to make room
+        """
+        with self._condition:
+            queue = self._queues.setdefault(stream_id, deque())
+            dropped = False
+            if len(queue) >= self.max_queue:
+                queue.popleft()
+                self._pending -= 1
+                dropped = True
+            queue.append((face, captured_at, callback))
+            self._pending += 1
+            self._condition.notify()
+            return not dropped
+
+    def remove_stream(self, stream_id):
+        with self._condition:
+            queue = self._queues.pop(stream_id, None)
+            if queue:
+                self._pending -= len(queue)
+
+    def _take_batch(self):
+        """Pop up to max_batch items round-robin across streams (lock held)."""
+        streams = list(self._queues.keys())
+        if not streams:
+            return []
+        start = self._rotation % len(streams)
+        order = streams[start:] + streams[:start]
+        self._rotation += 1
+
+        batch = []
+        while len(batch) < self.max_batch and self._pending > 0:
+            for stream_id in order:
+                queue = self._queues[stream_id]
+                if queue:
+                    batch.append(queue.popleft())
+                    self._pending -= 1
+                    if len(batch) >= self.max_batch:
+                        break
+        return batch
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while self._running and self._pending == 0:
+                    self._condition.wait()
+                if not self._running:
+                    return
+                # Give other streams a moment to contribute to this batch
+                deadline = time.monotonic() + self.max_wait
+                while self._pending < self.max_batch:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0 or not self._running:
+                        break
+                    self._condition.wait(remaining)
+                batch = self._take_batch()
+
+            if not batch:
+                continue
+
+            try:
+                faces = np.stack([item[0] for item in batch])
+                results = labels_from_predictions(self.predict(faces))
+            except Exception as e:
+                print(f"Scheduler inference error: {e}")
+                results = [("Error", 0.0)] * len(batch)
+
+            self.batches += 1
+            self.batch_faces += len(batch)
+            done = time.perf_counter()
+            for (face, captured_at, callback), (emotion, confidence) in zip(batch, results):
+                try:
+                    callback(emotion, confidence, (done - captured_at) * 1000)
+                except Exception as e:
+                    print(f"Scheduler callback error: {e}")
+
+    def snapshot(self):
+        with self._condition:
+            queued = {stream_id: len(queue) for stream_id, queue in self._queues.items()}
+        return {
+            'batches': self.batches,
+            'mean_batch_size': round(self.batch_faces / self.batches, 2) if self.batches else 0,
+            'queued': queued
+        }
+
+class StreamSource:
+    """A capture thread for one source, sampling frames at sample_fps."""
+
+    def __init__(self, stream_id, source, scheduler, sample_fps=DEFAULT_SAMPLE_FPS, loop_files=True):
+        self.stream_id = stream_id
+        self.source = parse_source(source)
+        self.scheduler = scheduler
+        self.sample_fps = sample_fps
+        self.loop_files = loop_files
+        self.stats = StreamStats()
+        self.status = 'starting'
+        self.latest = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f'stream-{stream_id}', daemon=True)
+
+    @property
+    def is_file(self):
+        return isinstance(self.source, str) and os.path.isfile(self.source)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join(timeout=5)
+
+    def _on_result(self, emotion, confidence, latency_ms):
+        self.stats.record_latency(latency_ms)
+        self.latest = {'emotion': emotion, 'confidence': round(confidence, 4)}
+        emotion_events.publish(emotion, confidence, self.stream_id)
+
+    def _open(self):
+        capture = cv2.VideoCapture(self.source)
+        if not capture.isOpened():
+            capture.release()
+            return None
+        return capture
+
+    def _run(self):
+        interval = 1.0 / self.sample_fps if self.sample_fps > 0 else 0.0
+        while not self._stop.is_set():
+            capture = self._open()
+            if capture is None:
+                self.status = 'unavailable'
+                self._stop.wait(RECONNECT_DELAY)
+                continue
+
+            self.status = 'running'
+            # Files are paced at their native rate so they behave like live feeds
+            file_frame_interval = 0.0
+            if self.is_file:
+                fps = capture.get(cv2.CAP_PROP_FPS) or 30.0
+                file_frame_interval = 1.0 / fps
+
+            next_sample = time.perf_counter()
+            next_frame = time.perf_counter()
+            while not self._stop.is_set():
+                # grab() without retrieve() skips decoding frames we won't sample
+                if not capture.grab():
+                    break
+                now = time.perf_counter()
+                self.stats.add(frames_read=1)
+
+                if now >= next_sample:
+                    next_sample = now + interval
+                    success, frame = capture.retrieve()
+                    if success:
+                        self._process(frame, now)
+
+                if file_frame_interval:
+                    next_frame += file_frame_interval
+                    delay = next_frame - time.perf_counter()
+                    if delay > 0:
+                        self._stop.wait(delay)
+
+            capture.release()
+            if self.is_file and self.loop_files and not self._stop.is_set():
+                continue
+            if not self._stop.is_set():
+                self.status = 'reconnecting'
+                self._stop.wait(RECONNECT_DELAY)
+
+        self.status = 'stopped'
+
+    def _process(self, frame, captured_at):
+        self.stats.add(frames_sampled=1)
+        gray = get_arena().to_gray(frame)
+        for face_coords in detect_faces(gray):
+            face = extract_face(gray, face_coords)
+            if face is None:
+                continue
+            self.stats.add(faces_submitted=1)
+            if not self.scheduler.submit(self.stream_id, face, captured_at, self._on_result):
+                self.stats.add(faces_dropped=1)
+
+    def snapshot(self):
+        info = {
+            'stream_id': self.stream_id,
+            'source': str(self.source),
+            'sample_fps': self.sample_fps,
+            'status': self.status,
+            'latest': self.latest
+        }
+        info.update(self.stats.snapshot())
+        return info
+
+class StreamManager:
+    """Owns the shared scheduler and the set of active sources."""
+
+    def __init__(self, scheduler=None):
+        self.scheduler = scheduler or InferenceScheduler()
+        self._streams = {}
+        self._lock = threading.Lock()
+
+    def add_source(self, stream_id, source, sample_fps=DEFAULT_SAMPLE_FPS):
+        """
+        Start watching a source.
+
+        Raises:
+            ValueError: If stream_id is already in use
+        """
+        with self._lock:
+            if stream_id in self._streams:
+                raise ValueError(f"Stream '{stream_id}' already exists")
+            self.scheduler.start()
+            stream = StreamSource(stream_id, source, self.scheduler, sample_fps)
+            self._streams[stream_id] = stream
+        stream.start()
+        return stream
+
+    def remove_source(self, stream_id):
+        """Stop and remove a source; returns False if unknown."""
+        with self._lock:
+            stream = self._streams.pop(stream_id, None)
+        if stream is None:
+            return False
+        stream.stop()
+        self.scheduler.remove_stream(stream_id)
+        return True
+
+    def stats(self):
+        with self._lock:
+            streams = list(self._streams.values())
+        return {
+            'streams': [stream.snapshot() for stream in streams],
+            'scheduler': self.scheduler.snapshot()
+        }
+
+    def stop_all(self):
+        with self._lock:
+            stream_ids = list(self._streams.keys())
+        for stream_id in stream_ids:
+            self.remove_source(stream_id)
+        self.scheduler.stop()
+
+class _RemoteStream:
+    """Snapshot of a stream that runs in the model server process."""
+
+    def __init__(self, info):
+        self._info = info
+
+    def snapshot(self):
+        return dict(self._info)
+
+class RemoteStreamManager:
+    """
+    Proxy for the StreamManager hosted by the model server.
+
+    With several gunicorn workers a per-worker manager would let a stream added
+    through one worker be invisible to (and unremovable from) the others. The
+    model server owns the single manager instead, and its results are relayed
+    into this process's emotion_events for /api/emotion/stream?stream=<id>.
+    """
+
+    def __init__(self, address):
+        from model_server import ModelServerClient
+        self._client = ModelServerClient(address)
+        self._relay = threading.Thread(target=self._relay_events, name='stream-event-relay', daemon=True)
+        self._relay.start()
+
+    def add_source(self, stream_id, source, sample_fps=DEFAULT_SAMPLE_FPS):
+        """
+        Start watching a source in the model server.
+
+        Raises:
+            ValueError: If stream_id is already in use
+        """
+        return _RemoteStream(self._client.stream_command('add', stream_id, source, sample_fps))
+
+    def remove_source(self, stream_id):
+        """Stop and remove a source; returns False if unknown."""
+        return self._client.stream_command('remove', stream_id)
+
+    def stats(self):
+        return self._client.stream_command('stats')
+
+    def stop_all(self):
+        # Sources belong to the model server and stop with it
+        pass
+
+    def _relay_events(self):
+        """Republish results from the model server's streams in this process."""
+        version = 0
+        while True:
+            try:
+                states = self._client.stream_command('events', version, HEARTBEAT_SECONDS)
+            except Exception as e:
+                print(f"Stream event relay error: {e}")
+                time.sleep(RECONNECT_DELAY)
+                continue
+            for state in states:
+                version = state['version']
+                emotion_events.publish(state['emotion'], state['confidence'], state['stream'])
+
+_manager = None
+_manager_lock = threading.Lock()
+
+def get_stream_manager():
+    """
+    Return the process-wide stream manager, creating it on first call.
+
+    When MODEL_SERVER_ADDRESS is set (gunicorn), this is a proxy to the one
+    manager in the model server; otherwise sources run in this process.
+    """
+    global _manager
+    with _manager_lock:
+        if _manager is None:
+            address = os.environ.get('MODEL_SERVER_ADDRESS')
+            _manager = RemoteStreamManager(address) if address else StreamManager()
+    return _manager
+
+def set_stream_manager(manager):
+    """Install the process-wide manager (the model server routes its inference through its own queue)."""
+    global _manager
+    with _manager_lock:
+        _manager = manager
+
+def main():
+    """Run a set of sources from the command line and print stats periodically."""
+    parser = argparse.ArgumentParser(description='Watch multiple video sources for emotions')
+    parser.add_argument('--source', action='append', required=True,
+                        help='stream_id=source (device index, RTSP/HTTP URL or video file); repeatable')
+    parser.add_argument('--sample-fps', type=float, default=DEFAULT_SAMPLE_FPS,
+                        help='Frames sampled per second per stream')
+    parser.add_argument('--report-every', type=float, default=5.0, help='Seconds between stats reports')
+    args = parser.parse_args()
+
+    manager = get_stream_manager()
+    for spec in args.source:
+        stream_id, sep, source = spec.partition('=')
+        if not sep:
+            stream_id, source = f'stream{len(manager.stats()["streams"])}', spec
+        manager.add_source(stream_id, source, args.sample_fps)
+
+    try:
+        while True:
+            time.sleep(args.report_every)
+            stats = manager.stats()
+            print("=" * 60)
+            for stream in stats['streams']:
+                latency = stream['latency_ms']
+                print(f"{stream['stream_id']:<12} {stream['status']:<12} sampled={stream['frames_sampled']:<6} "
+                      f"faces={stream['faces_inferred']:<6} dropped={stream['faces_dropped']:<4} "
+                      f"p50={latency['p50']}ms p95={latency['p95']}ms latest={stream['latest']}")
+            print(f"Scheduler: {stats['scheduler']}")
+    except KeyboardInterrupt:
+        print("Stopping streams...")
+    finally:
+        manager.stop_all()
+
+if __name__ == '__main__':
+    main()
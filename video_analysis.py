@@ -0,0 +1,236 @@
+"""
+Offline Video Analysis
+Processes recorded footage into a per-second emotion timeline.
+
+Frames are sampled every N frames or every T seconds (seeking past skipped
+frames instead of decoding them), face detection runs on a thread pool, face
+crops from many frames are batched into large inference calls, and the
+timeline is written to the database in one bulk transaction.
+
+Usage:
+    python video_analysis.py footage.mp4 --every-seconds 0.5
+    python video_analysis.py footage.mp4 --every-n-frames 10 --batch-size 512
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+from face_emotions import detect_faces, extract_face, predict_faces, labels_from_predictions
+from database import insert_timeline_bulk
+from preprocessing import get_arena
+
+# Configuration
+DEFAULT_BATCH_SIZE = 256
+DEFAULT_DETECT_WIDTH = 640
+# Above this stride, seeking is cheaper than grabbing every skipped frame
+SEEK_STRIDE_THRESHOLD = 30
+
+def sample_frames(capture, stride):
+    """
+    Yield (frame_index, frame) for every stride-th frame of an open capture.
+
+    Short strides grab() (demux without full retrieve) past skipped frames;
+    long strides seek directly with CAP_PROP_POS_FRAMES.
+    """
+    frame_count = int(capture.get(cv2.CAP_PROP_FRAME_COUNT) or 0)
+    use_seek = stride >= SEEK_STRIDE_THRESHOLD and frame_count > 0
+    index = 0
+
+    while True:
+        if use_seek:
+            if index >= frame_count:
+                return
+            capture.set(cv2.CAP_PROP_POS_FRAMES, index)
+
+        success, frame = capture.read()
+        if not success:
+            return
+        yield index, frame
+
+        if not use_seek:
+            for _ in range(stride - 1):
+                if not capture.grab():
+                    return
+        index += stride
+
+def _detect_frame(frame, detect_width):
+    """Detect faces in one frame; returns a list of uint8 crops."""
+    gray = get_arena().to_gray(frame)
+    if detect_width and gray.shape[1] > detect_width:
+        scale = detect_width / gray.shape[1]
+        gray = cv2.resize(gray, (detect_width, int(gray.shape[0] * scale)), interpolation=cv2.INTER_AREA)
+
+    crops = []
+    for face_coords in detect_faces(gray):
+        face = extract_face(gray, face_coords)
+        if face is not None:
+            crops.append(face)
+    return crops
+
+class TimelineBuilder:
+    """Accumulates per-face predictions into per-second emotion summaries."""
+
+    def __init__(self):
+        self.counts = defaultdict(Counter)
+        self.confidence = defaultdict(lambda: defaultdict(float))
+
+    def add(self, second, emotion, confidence):
+        self.counts[second][emotion] += 1
+        self.confidence[second][emotion] += confidence
+
+    def rows(self):
+        """Return rows for insert_timeline_bulk, ordered by second."""
+        rows = []
+        for second in sorted(self.counts):
+            counts = self.counts[second]
+            dominant, count = counts.most_common(1)[0]
+            mean_confidence = self.confidence[second][dominant] / count
+            rows.append((second, dominant, round(mean_confidence, 4), sum(counts.values()), json.dumps(dict(counts))))
+        return rows
+
+def analyze_video(video_path, every_n_frames=None, every_seconds=None, batch_size=DEFAULT_BATCH_SIZE,
+                  workers=None, detect_width=DEFAULT_DETECT_WIDTH, save=True):
+    """
+    Analyse a video file and (optionally) store its per-second emotion timeline.
+
+    Args:
+        video_path (str): Path to the video file
+        every_n_frames (int): Sample every N frames
+        every_seconds (float): Sample every T seconds (used if every_n_frames is not set)
+        batch_size (int): Face crops per inference call
+        workers (int): Face detection threads (default: CPU count)
+        detect_width (int): Downscale frames wider than this before detection (0 = off)
+        save (bool): Write the timeline to the database
+
+    Returns:
+        dict: Timeline rows and throughput report
+    """
+    capture = cv2.VideoCapture(video_path)
+    if not capture.isOpened():
+        raise ValueError(f"Could not open video '{video_path}'")
+
+    fps = capture.get(cv2.CAP_PROP_FPS) or 30.0
+    total_frames = int(capture.get(cv2.CAP_PROP_FRAME_COUNT) or 0)
+    if every_n_frames:
+        stride = max(1, int(every_n_frames))
+    else:
+        stride = max(1, int(round((every_seconds or 1.0) * fps)))
+
+    timeline = TimelineBuilder()
+    pending_faces = []
+    pending_seconds = []
+    stats = Counter()
+    inference_seconds = 0.0
+
+    def flush():
+        nonlocal inference_seconds
+        if not pending_faces:
+            return
+        start = time.perf_counter()
+        results = labels_from_predictions(predict_faces(np.stack(pending_faces)))
+        inference_seconds += time.perf_counter() - start
+        for second, (emotion, confidence) in zip(pending_seconds, results):
+            timeline.add(second, emotion, confidence)
+        stats['batches'] += 1
+        pending_faces.clear()
+        pending_seconds.clear()
+
+    workers = workers or os.cpu_count() or 1
+    started = time.perf_counter()
+    last_index = 0
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='detect') as pool:
+        in_flight = []
+        for index, frame in sample_frames(capture, stride):
+            last_index = index
+            stats['frames_sampled'] += 1
+            in_flight.append((index, pool.submit(_detect_frame, frame, detect_width)))
+
+            # Bound decoded frames held in memory to a few per worker
+            while len(in_flight) > workers * 4:
+                done_index, future = in_flight.pop(0)
+                crops = future.result()
+                stats['faces'] += len(crops)
+                pending_faces.extend(crops)
+                pending_seconds.extend([int(done_index / fps)] * len(crops))
+                if len(pending_faces) >= batch_size:
+                    flush()
+
+        for done_index, future in in_flight:
+            crops = future.result()
+            stats['faces'] += len(crops)
+            pending_faces.extend(crops)
+            pending_seconds.extend([int(done_index / fps)] * len(crops))
+            if len(pending_faces) >= batch_size:
+                flush()
+        flush()
+
+    capture.release()
+    elapsed = time.perf_counter() - started
+
+    rows = timeline.rows()
+    if save:
+        insert_timeline_bulk(video_path, rows)
+
+    video_seconds = (total_frames or last_index + 1) / fps
+    report = {
+        'video_path': video_path,
+        'video_seconds': round(video_seconds, 2),
+        'fps': round(fps, 2),
+        'stride_frames': stride,
+        'frames_sampled': stats['frames_sampled'],
+        'faces': stats['faces'],
+        'inference_batches': stats['batches'],
+        'timeline_seconds': len(rows),
+        'elapsed_seconds': round(elapsed, 2),
+        'inference_seconds': round(inference_seconds, 2),
+        'sampled_frames_per_second': round(stats['frames_sampled'] / elapsed, 1) if elapsed else None,
+        'realtime_factor': round(video_seconds / elapsed, 1) if elapsed else None
+    }
+    return {'timeline': rows, 'report': report}
+
+def main():
+    """Command-line entry point."""
+    parser = argparse.ArgumentParser(description='Analyse a video file into a per-second emotion timeline')
+    parser.add_argument('video', help='Path to the video file')
+    sampling = parser.add_mutually_exclusive_group()
+    sampling.add_argument('--every-n-frames', type=int, help='Sample every N frames')
+    sampling.add_argument('--every-seconds', type=float, default=1.0, help='Sample every T seconds (default: 1.0)')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE, help='Face crops per inference batch')
+    parser.add_argument('--workers', type=int, default=None, help='Face detection threads (default: CPU count)')
+    parser.add_argument('--detect-width', type=int, default=DEFAULT_DETECT_WIDTH,
+                        help='Downscale wider frames to this width before detection (0 = off)')
+    parser.add_argument('--no-save', action='store_true', help='Do not write the timeline to the database')
+    args = parser.parse_args()
+
+    try:
+        result = analyze_video(
+            args.video,
+            every_n_frames=args.every_n_frames,
+            every_seconds=args.every_seconds,
+            batch_size=args.batch_size,
+            workers=args.workers,
+            detect_width=args.detect_width,
+            save=not args.no_save
+        )
+    except Exception as e:
+        print(f"Error analysing video: {e}")
+        sys.exit(1)
+
+    report = result['report']
+    print("=" * 60)
+    print("Video Analysis Summary")
+    print("=" * 60)
+    for key, value in report.items():
+        print(f"{key.replace('_', ' ').title()}: {value}")
+    print("=" * 60)
+
+if __name__ == '__main__':
+    main()